@@ -0,0 +1,231 @@
+"""Precompiled sprite sheets: every sheet under data/, decoded and colorized
+for every saturation we use, in one binary file under cache/. With it, the
+game never has to decode a PNG or run Graphics.colorize to get a tile.
+
+The file is rebuilt whenever a source sheet changes: we check mtimes, and if
+an mtime moved (a fresh checkout, say) we compare sha1s before deciding. If
+the sha1 still matches, the new mtime gets written down so we don't have to
+check again next time.
+
+What's stored is the sheets' own RGB, colorized but never converted to the
+display's format, so a cache built on one display (the 8 bit one headless
+runs get, say) is just as good on any other.
+
+Usage: python assets.py [--force]   (builds the cache ahead of time; the game
+                                     also builds it on first launch)"""
+
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import time
+
+import numpy as N
+import pygame
+
+ROOT_DIR = os.path.dirname(os.path.realpath(__file__)) + "/../"
+DATA_DIR = ROOT_DIR + "data/"
+CACHE_DIR = ROOT_DIR + "cache/"
+CACHE_FILE = CACHE_DIR + "assets.bin"
+
+ALL_SATURATIONS = [(r, g, b) for r in (0, 1) for g in (0, 1) for b in (0, 1)]
+
+# Sheet (relative to DATA_DIR) -> the saturations to precompile it in. The map
+# is only ever read uncolored.
+SOURCES = { "sprites/tiles.png"   : ALL_SATURATIONS
+          , "sprites/sprites.png" : ALL_SATURATIONS
+          , "sprites/hud.png"     : ALL_SATURATIONS
+          , "maps/map.png"        : [(1, 1, 1)]
+          }
+
+# The file is HEADER, then the marshalled index, then every sheet's pixels
+# as raw RGB, back to back. The index looks like
+#   { "stamps": { name: (mtime, sha1) }
+#   , "sheets": { (name, saturation): (offset past the index, (width, height)) }
+#   }
+MAGIC = "FATHOMA2"
+HEADER = struct.Struct("<8sI")
+
+def source_name(file_name):
+  """FILE_NAME (a path to a sheet) as it's keyed in the cache."""
+  return os.path.relpath(os.path.realpath(file_name), os.path.realpath(DATA_DIR))
+
+def sha1_of(name):
+  with open(DATA_DIR + name, "rb") as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+def stamp(name):
+  return (os.path.getmtime(DATA_DIR + name), sha1_of(name))
+
+class AssetCache(object):
+  """A cache file, mapped into memory. Sheets only get turned into surfaces
+  the first time somebody asks for them."""
+
+  def __init__(self, path=CACHE_FILE):
+    self.file = open(path, "rb")
+    self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, index_length = HEADER.unpack_from(self.data, 0)
+    if magic != MAGIC:
+      self.close()
+      raise ValueError("%s isn't an asset cache" % path)
+
+    self.index = marshal.loads(self.data[HEADER.size:HEADER.size + index_length])
+    self.base = HEADER.size + index_length
+    self.surfaces = {}
+
+    # Whether load() had to build this cache first.
+    self.built = False
+
+    # Sheets that fresh() found touched but not changed.
+    self.touched = []
+
+  def close(self):
+    self.surfaces = {}
+    self.data.close()
+    self.file.close()
+
+  def fresh(self, sources=SOURCES):
+    """Whether this cache has everything in SOURCES, built from the sheets
+    as they are on disk now. Sheets that were touched but not changed go in
+    self.touched."""
+    wanted = set((name, tuple(saturation)) for name in sources for saturation in sources[name])
+    if not wanted <= set(self.index["sheets"]):
+      return False
+
+    self.touched = []
+    for name in sources:
+      mtime, sha1 = self.index["stamps"][name]
+      if os.path.getmtime(DATA_DIR + name) != mtime:
+        if sha1_of(name) != sha1:
+          return False
+        self.touched.append(name)
+
+    return True
+
+  def restamp(self, path):
+    """Writes this cache back to PATH with the mtimes of self.touched
+    brought up to date. The pixels are copied over as they are."""
+    index = dict(self.index, stamps=dict(self.index["stamps"]))
+    for name in self.touched:
+      index["stamps"][name] = (os.path.getmtime(DATA_DIR + name), index["stamps"][name][1])
+
+    write(path, index, [self.data[self.base:]])
+
+  def has(self, file_name, saturation):
+    return (source_name(file_name), tuple(saturation)) in self.index["sheets"]
+
+  def size(self, file_name):
+    """(width, height) of the sheet at FILE_NAME, or None if we don't have it."""
+    name = source_name(file_name)
+    for (sheet_name, saturation), (offset, size) in self.index["sheets"].items():
+      if sheet_name == name:
+        return size
+    return None
+
+  def sheet(self, file_name, saturation):
+    """The whole sheet at FILE_NAME, colorized to SATURATION."""
+    key = (source_name(file_name), tuple(saturation))
+
+    if key not in self.surfaces:
+      offset, size = self.index["sheets"][key]
+      start = self.base + offset
+      pixels = self.data[start:start + size[0] * size[1] * 3]
+      self.surfaces[key] = pygame.image.fromstring(pixels, size, "RGB").convert()
+
+    return self.surfaces[key]
+
+def build(colorize_pixels, sources=SOURCES, path=CACHE_FILE):
+  """Decodes every sheet in SOURCES, colorizes it with COLORIZE_PIXELS
+  (that's Graphics.colorize_pixels) in each of its saturations and writes
+  the lot to PATH."""
+  index = {"stamps": {}, "sheets": {}}
+  chunks = []
+  offset = 0
+
+  for name in sorted(sources):
+    index["stamps"][name] = stamp(name)
+
+    # Not convert()ed: that would bring the pixels down to whatever the
+    # display can show.
+    sheet = pygame.surfarray.array3d(pygame.image.load(DATA_DIR + name))
+
+    for saturation in sources[name]:
+      colored = colorize_pixels(sheet, list(saturation))
+
+      # surfarrays are indexed [x, y]; the file goes row by row.
+      pixels = N.ascontiguousarray(colored.transpose(1, 0, 2), dtype=N.uint8).tostring()
+      index["sheets"][(name, tuple(saturation))] = (offset, sheet.shape[:2])
+      chunks.append(pixels)
+      offset += len(pixels)
+
+  write(path, index, chunks)
+
+def write(path, index, chunks):
+  """Writes a cache file with INDEX, followed by CHUNKS of pixels."""
+  index_data = marshal.dumps(index)
+
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+
+  # Write next to it and move it into place, so a half-written cache never
+  # gets loaded.
+  temp = path + ".tmp"
+  with open(temp, "wb") as f:
+    f.write(HEADER.pack(MAGIC, len(index_data)))
+    f.write(index_data)
+    for chunk in chunks:
+      f.write(chunk)
+  os.rename(temp, path)
+
+def load(colorize_pixels, sources=SOURCES, path=CACHE_FILE):
+  """The AssetCache at PATH, (re)building it first if it's missing or out of
+  date. None if that doesn't work out (a read-only checkout, say), in which
+  case callers should decode and colorize sheets themselves."""
+  try:
+    if os.path.exists(path):
+      try:
+        cache = AssetCache(path)
+      except (ValueError, EOFError, struct.error):
+        # Made by an older version, or cut short. Build it again.
+        cache = None
+
+      if cache is not None and cache.fresh(sources):
+        if not cache.touched:
+          return cache
+
+        cache.restamp(path)
+        cache.close()
+        return AssetCache(path)
+
+      if cache is not None:
+        cache.close()
+
+    print "Building asset cache..."
+    build(colorize_pixels, sources, path)
+
+    cache = AssetCache(path)
+    cache.built = True
+    return cache
+  except (IOError, OSError, ValueError, EOFError, struct.error), e:
+    print "Not using the asset cache:", e
+    return None
+
+if __name__ == "__main__":
+  import sys
+
+  os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+  pygame.init()
+  pygame.display.set_mode((1, 1))
+
+  import main
+
+  if "--force" in sys.argv and os.path.exists(CACHE_FILE):
+    os.remove(CACHE_FILE)
+
+  start = time.time()
+  cache = load(main.Graphics.colorize_pixels)
+  if cache is not None:
+    print "%s: %d sheets, %d bytes, %.2fs" % (os.path.normpath(CACHE_FILE), len(cache.index["sheets"]),
+                                              len(cache.data), time.time() - start)
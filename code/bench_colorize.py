@@ -0,0 +1,77 @@
+"""Benchmarks Graphics.colorize against the old per-pixel Graphics.colorize_slow
+on the sprite sheets we actually ship, and checks that both give the same
+pixels for every saturation combination.
+
+Usage: python bench_colorize.py [repeats]"""
+
+import os
+import sys
+
+# No window needed, just a display so that convert() works. We ask it for 32
+# bit pixels in run(): the dummy driver defaults to a palette, which rounds
+# colors off differently depending on how a surface got there.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+import main
+from benchtools import time_it
+import spritesheet
+
+SHEETS = ["tiles.png", "sprites.png", "hud.png"]
+
+SATURATIONS = [[r, g, b] for r in [0, 1] for g in [0, 1] for b in [0, 1]]
+
+def same_pixels(a, b):
+  if a.get_size() != b.get_size() or a.get_colorkey() != b.get_colorkey():
+    return False
+
+  return pygame.image.tostring(a, "RGB") == pygame.image.tostring(b, "RGB")
+
+def slice_sheet(sheet, img_sz):
+  width, height = sheet.sheet.get_size()
+  return [sheet.image_at((x, y, img_sz, img_sz), colorkey=(255,255,255))
+          for x in range(0, width, img_sz) for y in range(0, height, img_sz)]
+
+def bench(file_name, repeats):
+  sheet = spritesheet.spritesheet(main.SPRITE_DIR + file_name)
+  tiles = slice_sheet(sheet, main.TILE_SIZE)
+
+  for rgb in SATURATIONS:
+    for tile in tiles:
+      if not same_pixels(main.Graphics.colorize(tile, rgb), main.Graphics.colorize_slow(tile, rgb)):
+        raise AssertionError("colorize differs from colorize_slow on %s %s" % (file_name, rgb))
+
+  def slow():
+    for rgb in SATURATIONS:
+      for tile in tiles:
+        main.Graphics.colorize_slow(tile, rgb)
+
+  def per_tile():
+    for rgb in SATURATIONS:
+      for tile in tiles:
+        main.Graphics.colorize(tile, rgb)
+
+  def per_sheet():
+    # What SheetRegistry and get_tilesheet_image do: colorize the whole
+    # sheet once, then cut the tiles out of it.
+    width, height = sheet.sheet.get_size()
+    for rgb in SATURATIONS:
+      colored = main.Graphics.colorize(sheet.sheet, rgb)
+      for x in range(0, width, main.TILE_SIZE):
+        for y in range(0, height, main.TILE_SIZE):
+          colored.subsurface((x, y, main.TILE_SIZE, main.TILE_SIZE)).copy()
+
+  return time_it(slow, repeats), time_it(per_tile, repeats), time_it(per_sheet, repeats)
+
+def run(repeats):
+  pygame.init()
+  pygame.display.set_mode((1, 1), 0, 32)
+
+  print "%-12s %12s %12s %12s %8s" % ("sheet", "per-pixel", "per-tile", "per-sheet", "speedup")
+  for file_name in SHEETS:
+    slow, per_tile, per_sheet = bench(file_name, repeats)
+    print "%-12s %10.2fms %10.2fms %10.2fms %7.1fx" % (file_name, slow * 1000, per_tile * 1000,
+                                                      per_sheet * 1000, slow / max(per_sheet, 1e-9))
+
+if __name__ == "__main__":
+  run(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,79 @@
+"""Benchmarks a tick of EntityManager.update, which runs the fallable system
+(gravity for every fallable entity, one numpy pass over its ComponentStore)
+and then calls every entity's update, against the way components used to
+work: every component wrapping update() in another Python call, per entity.
+
+Usage: python bench_components.py [ticks]"""
+
+import os
+import sys
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import main
+from benchtools import time_it
+
+COUNTS = [100, 1000, 5000, 10000]
+
+@main.fallable()
+@main.healthable(3)
+class Falling(main.Entity):
+  def __init__(self):
+    main.Entity.__init__(self, 0, 0, main.TILE_SIZE)
+
+  def update(self, entities):
+    pass
+
+# The old components, for comparison.
+
+def wrapped_fallable(klass, gravity=main.GRAVITY):
+  def update(self, entities):
+    self.v[1] += gravity
+    klass.update(self, entities)
+
+  return main.extend(klass, 'fallable', update)
+
+def wrapped_healthable(klass, health):
+  def __init__(self, *args, **kwargs):
+    klass.__init__(self, *args, **kwargs)
+    self.health = health
+
+  return main.extend(klass, 'healthable', __init__)
+
+class Plain(main.Entity):
+  def __init__(self):
+    main.Entity.__init__(self, 0, 0, main.TILE_SIZE)
+
+  def update(self, entities):
+    pass
+
+WrappedFalling = wrapped_fallable(wrapped_healthable(Plain, 3))
+
+def bench(count, ticks):
+  entities = main.EntityManager()
+  for _ in range(count):
+    entities.add(Falling())
+
+  wrapped = [WrappedFalling() for _ in range(count)]
+  def wrapped_update():
+    for entity in wrapped:
+      entity.update(entities)
+
+  batched = time_it(entities.update, ticks)
+  old = time_it(wrapped_update, ticks)
+
+  # Both should have fallen just as far.
+  expected = ticks * main.GRAVITY
+  if abs(wrapped[-1].v[1] - expected) > 1e-6 or abs(entities.get_all_of(Falling)[0].v[1] - expected) > 1e-6:
+    raise AssertionError("gravity applied differently")
+
+  return batched, old
+
+def run(ticks):
+  print "%8s %12s %12s %10s" % ("count", "update", "wrapped", "speedup")
+  for count in COUNTS:
+    batched, old = bench(count, ticks)
+    print "%8d %10.3fms %10.3fms %9.1fx" % (count, batched * 1000, old * 1000, old / batched)
+
+if __name__ == "__main__":
+  run(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -0,0 +1,60 @@
+"""Benchmarks Graphics.desaturate (saturation applied to the whole frame in
+place) against doing the same with copies, the way Graphics.post_process
+does, on a full SIZE frame of the actual game. Checks that desaturate gives
+the same pixels as colorize, and that it stays under
+Graphics.POST_PROCESS_BUDGET.
+
+Usage: python bench_post_process.py [repeats]"""
+
+import os
+import sys
+
+# No window needed.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+import main
+from benchtools import time_it
+
+SATURATIONS = [[r, g, b] for r in [0, 1] for g in [0, 1] for b in [0, 1] if min(r, g, b) == 0]
+
+def copying(screen, rgb):
+  """desaturate, but with the copies post_process makes."""
+  pixels = pygame.surfarray.array3d(screen)
+  gray = (pixels.sum(axis=2) / 3).astype(main.N.uint8)
+  colored = main.N.array(gray[:, :, main.N.newaxis] * main.N.array(rgb, dtype=main.N.uint8))
+  screen.blit(pygame.surfarray.make_surface(colored), (0, 0))
+
+def run(repeats):
+  pygame.init()
+
+  # 32 bit pixels, like a real display would give us; the dummy driver
+  # defaults to a palette.
+  game = main.Game(post_process=True, depth=32)
+  game.render()
+  frame = game.screen.copy()
+  screen = game.screen
+
+  print "%-10s %12s %12s %8s" % ("rgb", "copying", "in place", "budget")
+
+  over = False
+  for rgb in SATURATIONS:
+    screen.blit(frame, (0, 0))
+    main.Graphics.desaturate(screen, rgb)
+    expected = main.Graphics.colorize(frame, rgb)
+    if pygame.image.tostring(screen, "RGB") != pygame.image.tostring(expected, "RGB"):
+      raise AssertionError("desaturate differs from colorize for %s" % rgb)
+
+    copied = time_it(lambda: copying(screen, rgb), repeats)
+    in_place = time_it(lambda: main.Graphics.desaturate(screen, rgb), repeats)
+
+    ok = in_place <= main.Graphics.POST_PROCESS_BUDGET
+    over = over or not ok
+    print "%-10s %10.2fms %10.2fms %8s" % (rgb, copied * 1000, in_place * 1000, "ok" if ok else "OVER")
+
+  print "frame %dx%d, budget %.1fms" % (main.SIZE[0], main.SIZE[1], main.Graphics.POST_PROCESS_BUDGET * 1000)
+  if over:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  run(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
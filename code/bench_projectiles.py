@@ -0,0 +1,75 @@
+"""Stress test for Fireballs: keeps N fireballs flying around the first room
+(throwing new ones as old ones burn out) and times whole ticks, update and
+render, for growing N. Also times the update the old way, one Map.sweep per
+fireball, to compare against.
+
+Usage: python bench_projectiles.py [ticks]"""
+
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+import main
+
+COUNTS = [100, 1000, 5000, 10000]
+
+DIRECTIONS = [main.LEFT, main.RIGHT, main.UP, main.DOWN]
+
+def top_up(fireballs, count, cells):
+  """Throws fireballs from random open cells until COUNT are flying."""
+  for _ in range(count - len(fireballs)):
+    x, y = random.choice(cells)
+    fireballs.spawn(x * main.TILE_SIZE + 5, y * main.TILE_SIZE + 5, random.choice(DIRECTIONS))
+
+def scalar_update(fireballs):
+  """What updating them cost when every fireball was its own entity."""
+  for i in main.N.flatnonzero(fireballs.alive).tolist():
+    fireballs.map.sweep(fireballs.xs[i], fireballs.ys[i], fireballs.size, fireballs.size,
+                        fireballs.dxs[i], fireballs.dys[i])
+
+def bench(count, ticks, screen, map, cells):
+  random.seed(count)
+
+  fireballs = main.Fireballs(map)
+  entities = main.EntityManager()
+
+  update = render = scalar = 0.0
+  for _ in range(ticks):
+    top_up(fireballs, count, cells)
+
+    start = time.time()
+    scalar_update(fireballs)
+    scalar += time.time() - start
+
+    start = time.time()
+    fireballs.update(entities)
+    update += time.time() - start
+
+    start = time.time()
+    fireballs.render(screen)
+    render += time.time() - start
+
+  return update / ticks, render / ticks, scalar / ticks
+
+def run(ticks):
+  pygame.init()
+  screen = pygame.display.set_mode(main.SIZE)
+
+  map = main.Map(main.TILE_SIZE, main.MAP_SIZE, "map.png")
+  map.new_map(main.EntityManager(), 0, 0, rel=False)
+  cells = map.room.open_cells()
+
+  print "%8s %10s %10s %10s %12s %12s" % ("count", "update", "render", "tick/s", "per-sweep", "speedup")
+  for count in COUNTS:
+    update, render, scalar = bench(count, ticks, screen, map, cells)
+    per_second = 1.0 / (update + render)
+    marker = "" if per_second >= main.TICKS_PER_SECOND else "  too slow"
+    print "%8d %8.2fms %8.2fms %10.0f %10.2fms %11.1fx%s" % (count, update * 1000, render * 1000, per_second,
+                                                           scalar * 1000, scalar / update, marker)
+
+if __name__ == "__main__":
+  run(int(sys.argv[1]) if len(sys.argv) > 1 else 48)
@@ -0,0 +1,132 @@
+"""Benchmarks building rooms (decoding map.png, making the tile kind and
+occupancy arrays and baking the layer) and how much memory a built room
+holds on to, against the old way: get_at for every cell and a Tile entity,
+with its own sprite, per cell.
+
+Usage: python bench_rooms.py [repeats]"""
+
+import gc
+import os
+import resource
+import sys
+
+# No window needed, just a display so that convert() works.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+import main
+from benchtools import time_it
+
+def all_rooms(map):
+  rooms_across, rooms_down = map.rooms()
+  return [(x, y) for x in range(rooms_across) for y in range(rooms_down)]
+
+def max_rss_kb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# The old rooms, for comparison.
+
+class OldTile(main.Entity):
+  """One cell of the map, the way it used to be: an entity with a sprite."""
+
+  def __init__(self, position, type, size, grid, cell):
+    main.Entity.__init__(self, position[0], position[1], size)
+
+    self.type = type
+    self.grid = grid
+    self.cell = cell
+
+    img_x, img_y = main.Tile.TYPES[type][1]
+    self.sprite = main.Image("tiles.png", img_x, img_y, 30, 30, main.TILE_SIZE, main.world_saturation())
+    self.sprite.set_position(position)
+
+  def image(self, saturation):
+    img_x, img_y = main.Tile.TYPES[self.type][1]
+    return main.get_tilesheet_image(main.SPRITE_DIR + "tiles.png", img_x, img_y, main.TILE_SIZE, saturation)
+
+def old_build_room(map, mapx, mapy):
+  """Map.build_room before rooms were arrays: tiles indexed [x][y]."""
+  map_data = main.get_tilesheet_image(os.path.join(main.MAP_DIR, map.file_name), mapx, mapy, map.map_sz, [1,1,1])
+
+  tiles = [[None for y in range(map.map_sz)] for x in range(map.map_sz)]
+  grid = main.N.zeros((map.map_sz, map.map_sz), dtype=main.N.uint8)
+
+  for x in range(map.map_sz):
+    for y in range(map.map_sz):
+      rgb_val = tuple(map_data.get_at((x, y)))[:3]
+
+      grid[x, y] = main.Tile.flags_for(rgb_val)
+      tiles[x][y] = OldTile((x * map.img_sz, y * map.img_sz), rgb_val, map.img_sz, grid, (x, y))
+
+  saturation = main.world_saturation()[:]
+  layer = pygame.Surface((map.size, map.size)).convert()
+  for x, y in map.all_cells():
+    tile = tiles[x][y]
+    layer.fill((0, 0, 0), (tile.x, tile.y, tile.size, tile.size))
+    layer.blit(tile.image(saturation), (tile.x, tile.y))
+
+  return main.Room(mapx, mapy, tiles, grid, layer, saturation)
+
+def rss_per_room(build, keys, count, kept):
+  """Bytes of memory each of COUNT rounds of rooms built by BUILD holds on
+  to, layers aside. They go in KEPT, so they stay around for the next
+  measurement to start from."""
+  gc.collect()
+  before = max_rss_kb()
+  rooms = 0
+  for _ in range(count):
+    for key in keys:
+      room = build(*key)
+      room.layer = None
+      kept.append(room)
+      rooms += 1
+  gc.collect()
+  return (max_rss_kb() - before) * 1024.0 / rooms
+
+def run(repeats):
+  pygame.init()
+  pygame.display.set_mode(main.SIZE)
+
+  map = main.Map(main.TILE_SIZE, main.MAP_SIZE, "map.png")
+  keys = all_rooms(map)
+
+  # Warm the sheet and tile image caches; we're not timing PNG loading.
+  for key in keys:
+    map.build_room(*key)
+
+  def decode():
+    for mapx, mapy in keys:
+      map_data = main.get_tilesheet_image(os.path.join(main.MAP_DIR, map.file_name), mapx, mapy, map.map_sz, [1,1,1])
+      map.make_map(map_data)
+
+  def build():
+    for key in keys:
+      map.build_room(*key)
+
+  def old_build():
+    for mapx, mapy in keys:
+      old_build_room(map, mapx, mapy)
+
+  per_decode = time_it(decode, repeats) / len(keys)
+  per_build = time_it(build, repeats) / len(keys)
+  old_per_build = time_it(old_build, repeats) / len(keys)
+
+  room = map.build_room(*keys[0])
+  array_bytes = room.kinds.nbytes + room.grid.nbytes
+  layer_bytes = main.surface_bytes(room.layer)
+
+  # What a room really costs once Python's overhead is in.
+  kept = []
+  rss = rss_per_room(map.build_room, keys, repeats * 10, kept)
+  old_rss = rss_per_room(lambda mapx, mapy: old_build_room(map, mapx, mapy), keys, repeats * 10, kept)
+
+  print "%d rooms, %d repeats" % (len(keys), repeats)
+  print "%-24s %14s %14s" % ("per room", "arrays", "tile entities")
+  print "%-24s %14.2f" % ("decode + arrays, ms", per_decode * 1000)
+  print "%-24s %14.2f %14.2f" % ("full build, ms", per_build * 1000, old_per_build * 1000)
+  print "%-24s %14d" % ("arrays, bytes", array_bytes)
+  print "%-24s %14d" % ("layer, bytes", layer_bytes)
+  print "%-24s %14d %14d" % ("rss without layer, bytes", rss, old_rss)
+
+if __name__ == "__main__":
+  run(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
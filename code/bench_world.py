@@ -0,0 +1,116 @@
+"""Benchmarks big maps as worlds (see world.py) against the same maps as
+images: how long it takes to open the map and build the rooms around the
+player, and how much memory that takes. The maps are map.png's rooms
+shuffled around into SIDE x SIDE rooms. Every measurement runs in a fresh
+process, so they don't share caches.
+
+Usage: python bench_world.py [side ...]"""
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+import main
+import world
+
+SIDES = [8, 64, 256]
+
+# Bigger than this and the image takes too long to write to bother.
+MAX_IMAGE_SIDE = 256
+
+def rss_kb():
+  with open("/proc/self/statm") as f:
+    return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024
+
+def source_rooms():
+  """Tile kinds of every room in map.png."""
+  map = main.Map(main.TILE_SIZE, main.MAP_SIZE, "map.png")
+  rooms_across, rooms_down = map.rooms()
+  return [map.build_room(x, y).kinds for x in range(rooms_across) for y in range(rooms_down)]
+
+def make_maps(side, directory):
+  """A SIDE x SIDE room world, and the same as an image if it's not too big."""
+  rooms = source_rooms()
+  picks = random.Random(side)
+  layout = [[picks.choice(rooms) for x in range(side)] for y in range(side)]
+
+  world_path = os.path.join(directory, "big.world")
+  world.write(world_path, main.MAP_SIZE, side, side, main.Tile.KINDS, lambda x, y: layout[y][x])
+
+  if side > MAX_IMAGE_SIDE:
+    return world_path, None
+
+  colors = main.N.array(main.Tile.KINDS, dtype=main.N.uint8)
+  sz = main.MAP_SIZE
+  pixels = main.N.zeros((side * sz, side * sz, 3), dtype=main.N.uint8)
+  for y in range(side):
+    for x in range(side):
+      pixels[x * sz:(x + 1) * sz, y * sz:(y + 1) * sz] = colors[layout[y][x]]
+
+  image_path = os.path.join(directory, "big.png")
+  pygame.image.save(pygame.surfarray.make_surface(pixels), image_path)
+  return world_path, image_path
+
+def measure(path):
+  """Opens the map at PATH and builds the room in the middle and its
+  neighbours, like walking in and looking around would. Prints seconds to
+  open, seconds per room and kB of memory it took."""
+  pygame.init()
+  pygame.display.set_mode(main.SIZE)
+
+  # Have the tile images ready; we're not timing those.
+  main.Map(main.TILE_SIZE, main.MAP_SIZE, "map.png").build_room(0, 0)
+
+  before = rss_kb()
+
+  start = time.time()
+  map = main.Map(main.TILE_SIZE, main.MAP_SIZE, path)
+  rooms_across, rooms_down = map.rooms()
+  opened = time.time() - start
+
+  x, y = rooms_across // 2, rooms_down // 2
+  nearby = [(x, y), (x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)]
+
+  start = time.time()
+  for key in nearby:
+    room = map.build_room(*key)
+  per_room = (time.time() - start) / len(nearby)
+
+  print opened, per_room, rss_kb() - before
+
+def run_measure(path):
+  output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--measure", path],
+                                   stderr=open(os.devnull, "w"))
+  return [float(value) for value in output.split("\n")[-2].split()]
+
+def run(sides):
+  pygame.init()
+  pygame.display.set_mode(main.SIZE)
+
+  print "%6s %7s %12s %12s %12s %12s" % ("side", "rooms", "format", "open", "per room", "memory")
+
+  for side in sides:
+    directory = tempfile.mkdtemp()
+    try:
+      world_path, image_path = make_maps(side, directory)
+
+      for name, path in [("world", world_path), ("image", image_path)]:
+        if path is None:
+          continue
+        opened, per_room, kb = run_measure(path)
+        print "%6d %7d %12s %10.2fms %10.2fms %10dkB" % (side, side * side, name, opened * 1000, per_room * 1000, kb)
+    finally:
+      shutil.rmtree(directory)
+
+if __name__ == "__main__":
+  if sys.argv[1:2] == ["--measure"]:
+    measure(sys.argv[2])
+  else:
+    run([int(side) for side in sys.argv[1:]] or SIDES)
@@ -0,0 +1,10 @@
+"""Bits the bench_*.py benchmarks share."""
+
+import time
+
+def time_it(func, repeats):
+  """Seconds FUNC takes per call, averaged over REPEATS calls."""
+  start = time.time()
+  for _ in range(repeats):
+    func()
+  return (time.time() - start) / repeats
@@ -0,0 +1,10 @@
+"""Blitting helpers that work on every pygame we run on."""
+
+def blit_all(surface, sequence):
+  """Draws every (source, position[, area]) in SEQUENCE onto SURFACE, in one
+  Surface.blits call where there is one (it only showed up in pygame 1.9.4)."""
+  if hasattr(surface, "blits"):
+    surface.blits(sequence, doreturn=False)
+  else:
+    for blit in sequence:
+      surface.blit(*blit)
@@ -0,0 +1,108 @@
+"""Column-wise storage for component data (velocity, health, ...), so that a
+system can go over every entity with a component in one numpy pass instead
+of one Python call per entity.
+
+Components declare their fields; entities see them as ordinary attributes
+through Column descriptors. Until an entity is attached to a store (which
+EntityManager does on add) its values just live on the entity."""
+
+import numpy as N
+
+class ComponentStore(object):
+  """The data of component COMPONENT: one array per field, one row per
+  attached entity. Rows of detached entities go on a free list and get
+  reused; LIVE says which rows are in use. FIELDS maps field name -> (dtype,
+  shape of one entity's value)."""
+
+  def __init__(self, component, fields, capacity=16):
+    self.component = component
+    self.fields = fields
+    self.columns = dict((name, N.zeros((capacity,) + shape, dtype=dtype))
+                        for name, (dtype, shape) in fields.items())
+    self.live = N.zeros(capacity, dtype=bool)
+    self.free = range(capacity - 1, -1, -1)
+    self.rows = {}
+
+  def __len__(self):
+    return len(self.rows)
+
+  def __contains__(self, entity):
+    return entity in self.rows
+
+  def grow(self):
+    capacity = len(self.live)
+    for name, column in self.columns.items():
+      self.columns[name] = N.concatenate([column, N.zeros_like(column)])
+    self.live = N.concatenate([self.live, N.zeros_like(self.live)])
+    self.free = range(2 * capacity - 1, capacity - 1, -1) + self.free
+
+  def attach(self, entity):
+    """Moves ENTITY's values for our fields into a row of their own."""
+    if entity in self.rows:
+      return
+
+    if not self.free:
+      self.grow()
+
+    row = self.free.pop()
+    for name in self.fields:
+      self.columns[name][row] = getattr(entity, name)
+
+    self.live[row] = True
+    self.rows[entity] = row
+    stores(entity)[self.component] = (self, row)
+
+  def detach(self, entity):
+    """Gives ENTITY its values back and frees up its row."""
+    if entity not in self.rows:
+      return
+
+    row = self.rows.pop(entity)
+    del stores(entity)[self.component]
+
+    loose = entity.__dict__.setdefault("_loose", {})
+    for name in self.fields:
+      value = self.columns[name][row]
+      loose[name] = value.tolist() if value.ndim else value.item()
+
+    self.live[row] = False
+    self.free.append(row)
+
+def stores(entity):
+  """The (store, row) ENTITY is attached to, for each of its components."""
+  return entity.__dict__.setdefault("_stores", {})
+
+class Column(object):
+  """An attribute backed by field NAME of COMPONENT's store, once the entity
+  is attached to one, and by the entity itself until then. Starts out as
+  DEFAULT. Arrays (like v) come back as views of the store, so
+  self.v[1] += 3 writes through; don't hang on to them, since stores move
+  when they grow."""
+
+  def __init__(self, component, name, default=None):
+    self.component = component
+    self.name = name
+    self.default = default
+
+  def __get__(self, entity, owner):
+    if entity is None:
+      return self
+
+    attached = stores(entity).get(self.component)
+    if attached is None:
+      loose = entity.__dict__.setdefault("_loose", {})
+      if self.name not in loose:
+        loose[self.name] = list(self.default) if isinstance(self.default, list) else self.default
+      return loose[self.name]
+
+    store, row = attached
+    value = store.columns[self.name][row]
+    return value if value.ndim else value.item()
+
+  def __set__(self, entity, value):
+    attached = stores(entity).get(self.component)
+    if attached is None:
+      entity.__dict__.setdefault("_loose", {})[self.name] = value
+    else:
+      store, row = attached
+      store.columns[self.name][row] = value
@@ -0,0 +1,89 @@
+"""Draws text by blitting pre-rendered glyphs out of an atlas, instead of
+asking the font to render whole strings every time."""
+
+import string as strings
+
+import pygame
+
+from rendertext import layout_textrect
+from blitting import blit_all
+
+class GlyphAtlas(object):
+  """Every glyph of FONT in COLOR, rendered once and packed side by side into
+  a single surface. Glyphs we didn't see coming get added the first time
+  they're drawn.
+
+  The atlas background is KEY, which is also its colorkey (same trick as
+  render_textrect, which is why our text colors are almost-but-not-quite
+  white)."""
+
+  CHARACTERS = strings.digits + strings.ascii_letters + strings.punctuation + " "
+
+  def __init__(self, font, color, key=(255, 255, 255)):
+    self.font = font
+    self.color = color
+    self.key = key
+    self.height = font.get_height()
+
+    # char -> (area in self.surface, advance)
+    self.glyphs = {}
+    self.surface = None
+    self.add(self.CHARACTERS)
+
+  def add(self, chars):
+    chars = [c for c in set(chars) if c not in self.glyphs]
+    if not chars:
+      return
+
+    rendered = [(c, self.font.render(c, False, self.color)) for c in chars]
+
+    old_width = self.surface.get_width() if self.surface else 0
+    width = old_width + sum(image.get_width() for c, image in rendered)
+
+    surface = pygame.Surface((max(width, 1), self.height))
+    surface.fill(self.key)
+    if self.surface:
+      surface.blit(self.surface, (0, 0))
+
+    x = old_width
+    for c, image in rendered:
+      surface.blit(image, (x, 0))
+      advance = self.font.metrics(c)[0][4]
+      self.glyphs[c] = (pygame.Rect(x, 0, image.get_width(), self.height), advance)
+      x += image.get_width()
+
+    surface.set_colorkey(self.key)
+    self.surface = surface
+
+  def width(self, text):
+    self.add(text)
+    return sum(self.glyphs[c][1] for c in text)
+
+  def positions(self, text, x, y):
+    """(char, (x, y)) for every character of TEXT set on one line at (X, Y)."""
+    self.add(text)
+
+    placed = []
+    for c in text:
+      placed.append((c, (x, y)))
+      x += self.glyphs[c][1]
+    return placed
+
+  def blits(self, placed):
+    """Blit sequence (for Surface.blits) drawing the (char, position) pairs
+    in PLACED."""
+    return [(self.surface, position, self.glyphs[c][0]) for c, position in placed if c != " "]
+
+  def draw(self, surface, placed):
+    blit_all(surface, self.blits(placed))
+
+  def layout(self, text, rect, justification=0):
+    """Word-wraps TEXT like render_textrect would inside RECT and returns
+    where each glyph goes, relative to RECT's top left, as (char, (x, y))
+    pairs in reading order. Raises a TextRectException if it won't fit."""
+    placed = []
+
+    for line, (x, y) in layout_textrect(text, self.font, rect, justification):
+      placed += self.positions(line, x, y)
+
+    return placed
@@ -0,0 +1,130 @@
+"""Runs the game without a window, as fast as it will go, and reports how
+long ticks take.
+
+Usage: python headless.py [--ticks N] [--script NAME | --replay LOG] [--record LOG]
+                          [--map FILE] [--dirty] [--profile] [--post]
+
+--replay plays back an input log (see replay.py) instead of a script, for as
+many ticks as it has unless --ticks says otherwise, and stops with an error
+as soon as the game goes differently than it did when it was recorded."""
+
+import argparse
+import os
+import sys
+import time
+
+# Has to happen before pygame sets up the display.
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+
+import pygame
+import main
+
+# The dummy driver gives an 8 bit palette unless asked otherwise, and every
+# blit would pay for converting to it, which no real display makes us do.
+DEPTH = 32
+
+def demo_script():
+  """Walk right, jump, walk back and throw some fireballs, over and over."""
+  script = []
+  script += [([pygame.K_RIGHT], [])] * 30
+  script += [([pygame.K_RIGHT, pygame.K_z], [])] * 10
+  script += [([pygame.K_LEFT], [pygame.K_a])] + [([pygame.K_LEFT, pygame.K_x], [])] * 19
+  script += [([pygame.K_LEFT, pygame.K_z], [pygame.K_a])] * 20
+  return script
+
+SCRIPTS = { "idle": lambda: []
+          , "demo": demo_script
+          }
+
+def percentile(ordered, fraction):
+  if not ordered:
+    return 0.0
+  return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+class HeadlessRunner:
+  """A Game on SDL's dummy video driver, fed by INPUT_SOURCE (a
+  main.ScriptedInput, say) instead of the keyboard."""
+
+  def __init__(self, input_source=None, dirty_rects=False, profile=False, post_process=False, map_file="map.png"):
+    main.Input.source = input_source or main.ScriptedInput([])
+    self.game = main.Game(dirty_rects=dirty_rects, profile=profile, post_process=post_process,
+                          map_file=map_file, depth=DEPTH)
+    self.tick_times = []
+
+  def run(self, ticks):
+    """Steps the game TICKS times, with no frame rate cap, and returns the
+    stats for those ticks (see stats())."""
+    self.tick_times = []
+
+    profiler = self.game.profiler
+
+    for _ in range(ticks):
+      start = time.time()
+      if profiler:
+        profiler.begin_frame()
+
+      pygame.event.pump()
+      self.game.tick()
+
+      if profiler:
+        profiler.end_frame("wait")
+      self.tick_times.append(time.time() - start)
+
+    return self.stats()
+
+  def stats(self):
+    ordered = sorted(self.tick_times)
+    total = sum(ordered)
+
+    return { "ticks": len(ordered)
+           , "seconds": total
+           , "ticks_per_second": len(ordered) / total if total else 0.0
+           , "p50_ms": percentile(ordered, 0.5) * 1000
+           , "p99_ms": percentile(ordered, 0.99) * 1000
+           , "worst_ms": (ordered[-1] if ordered else 0.0) * 1000
+           }
+
+def report(stats):
+  print "%d ticks in %.2fs: %.1f ticks/s, p50 %.2fms, p99 %.2fms, worst %.2fms" % (
+    stats["ticks"], stats["seconds"], stats["ticks_per_second"],
+    stats["p50_ms"], stats["p99_ms"], stats["worst_ms"])
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Run the game headless and time it.")
+  parser.add_argument("--ticks", type=int, default=None, help="how many ticks to run (default 1000)")
+  parser.add_argument("--script", choices=sorted(SCRIPTS.keys()), default="demo")
+  parser.add_argument("--replay", metavar="LOG", help="play back an input log instead of a script")
+  parser.add_argument("--record", metavar="LOG", help="write the input to an input log")
+  parser.add_argument("--map", default="map.png", help="map image or world (see world.py) under data/maps")
+  parser.add_argument("--dirty", action="store_true", help="use dirty rectangle rendering")
+  parser.add_argument("--profile", action="store_true", help="print the perf overlay at the end")
+  parser.add_argument("--post", action="store_true", help="apply saturation as a post-process")
+  args = parser.parse_args()
+
+  if args.replay:
+    source = replayed = main.ReplayInput(args.replay)
+    ticks = args.ticks if args.ticks is not None else len(replayed.log)
+  else:
+    source = main.ScriptedInput(SCRIPTS[args.script](), loop=True)
+    ticks = args.ticks if args.ticks is not None else 1000
+
+  if args.record:
+    source = main.RecordingInput(source, args.record)
+
+  runner = HeadlessRunner(source, args.dirty, args.profile, args.post, args.map)
+  try:
+    report(runner.run(ticks))
+  except main.ReplayDivergedException, e:
+    print "Replay diverged at %s" % e
+    sys.exit(1)
+
+  if args.replay:
+    print "Replayed %d ticks of %s, state matched on every one." % (min(ticks, len(replayed.log)), args.replay)
+
+  if args.profile:
+    print runner.game.entities.get_one_of(main.PerfOverlay).describe()
+
+    rooms = runner.game.entities.get_one_of(main.Map).room_cache.stats()
+    print "room cache: %d/%d rooms, %d hits, %d misses (%.0f%%), %d evictions" % (
+      rooms["entries"], rooms["budget"], rooms["hits"], rooms["misses"],
+      rooms["hit_rate"] * 100, rooms["evictions"])
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+
+class LRUCache(object):
+  """A dict that forgets the least recently used entries once it gets too
+  heavy. By default every entry weighs 1, so BUDGET is just an entry count;
+  pass WEIGH to budget by something else (bytes, say).
+
+  Keeps hit/miss/eviction counters around so we can tell whether the budget
+  is any good."""
+
+  def __init__(self, budget, weigh=None):
+    self.budget = budget
+    self.weigh = weigh or (lambda value: 1)
+    self.contents = OrderedDict()
+    self.weights = {}
+    self.weight = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.contents)
+
+  def __contains__(self, key):
+    return key in self.contents
+
+  def get(self, key, default=None):
+    if key not in self.contents:
+      self.misses += 1
+      return default
+
+    self.hits += 1
+
+    # OrderedDict in 2.x has no move_to_end; re-inserting does the same.
+    value = self.contents.pop(key)
+    self.contents[key] = value
+    return value
+
+  def put(self, key, value):
+    if key in self.contents:
+      self.remove(key)
+
+    self.contents[key] = value
+    self.weights[key] = self.weigh(value)
+    self.weight += self.weights[key]
+
+    # Never evict the entry we just put in, even if it's over budget alone.
+    while self.weight > self.budget and len(self.contents) > 1:
+      oldest = next(iter(self.contents))
+      self.remove(oldest)
+      self.evictions += 1
+
+  def lookup(self, key, build):
+    """Returns the value for KEY, calling BUILD() to make (and cache) it the
+    first time it's asked for."""
+    if key in self.contents:
+      return self.get(key)
+
+    self.misses += 1
+    value = build()
+    self.put(key, value)
+    return value
+
+  def remove(self, key):
+    del self.contents[key]
+    self.weight -= self.weights.pop(key)
+
+  def clear(self):
+    self.contents.clear()
+    self.weights.clear()
+    self.weight = 0
+
+  def hit_rate(self):
+    total = self.hits + self.misses
+    return float(self.hits) / total if total else 0.0
+
+  def stats(self):
+    return { "entries": len(self.contents)
+           , "weight": self.weight
+           , "budget": self.budget
+           , "hits": self.hits
+           , "misses": self.misses
+           , "evictions": self.evictions
+           , "hit_rate": self.hit_rate()
+           }
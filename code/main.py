@@ -5,8 +5,24 @@ import pygame
 import pygame.font
 import numpy as N
 import math
+import threading
+import atexit
+import Queue
+import traceback
+import bisect
+import zlib
+from collections import OrderedDict
 import spritesheet
-from rendertext import render_textrect, TextRectException
+import assets
+from rendertext import cached_render_textrect, TextRectException
+from lrucache import LRUCache
+from glyphatlas import GlyphAtlas
+from blitting import blit_all
+from profiler import FrameProfiler
+from components import ComponentStore, Column
+import replay
+import world
+from timeit import default_timer
 
 #TODO: Move to untracted py file so there is no conflicts when someone changes this.
 DEBUG = False
@@ -32,16 +48,45 @@ DOWN = [0, 1]
 
 GRAVITY = 3
 
+# How far short of a wall Map.sweep stops things, in pixels.
+SKIN = 1
+
 UNCOLORED = 0
 COLORED = 1
 
+# Terrain flags, as stored in Map.grid.
+WALL = 1
+WATER = 2
+REDPLATFORM = 4
+
 TILE_SIZE = 20
 SIZE = (500, 500)
+
+# The simulation always runs at TICKS_PER_SECOND; we render as often as
+# MAX_FPS allows, and catch up at most MAX_CATCHUP_STEPS steps per frame.
+TICKS_PER_SECOND = 24
+MAX_FPS = 60
+MAX_CATCHUP_STEPS = 5
 MAP_SIZE = 20
 MAP_IN_PX = TILE_SIZE * MAP_SIZE
 
+# Entities at this depth and up (the HUD, the perf overlay, and dialog when
+# post-processing) are drawn on top of the world, and are left alone by the
+# saturation post-process.
+OVERLAY_DEPTH = 100
+
 # global saturation var (so ugly)
 g_saturation = [ COLORED, COLORED, COLORED ]
+
+# Whether saturation gets applied to the finished frame (see
+# Graphics.desaturate) instead of to every sprite and tile as it's loaded.
+g_post_process = False
+
+def world_saturation():
+  """What saturation to draw world sprites and tiles in."""
+  if g_post_process:
+    return [COLORED, COLORED, COLORED]
+  return g_saturation
  
 """ DECORATORS"""
 
@@ -60,21 +105,23 @@ def extend(klass, name, *args, **kwargs):
   new_type = type(klass)(name, (klass,), methods)
   return new_type
 
+# What each component keeps for every entity that has it, stored column-wise
+# (see ComponentStore): field -> (dtype, shape).
+COMPONENTS = { 'fallable'   : {'v': (float, (2,)), 'gravity': (float, ())}
+             , 'healthable' : {'health': (int, ())}
+             }
+
+# Components just declare their data. Whatever they do is done by a system
+# that EntityManager runs over all of them at once (see EntityManager.fall).
+
 @component
 def fallable(klass, gravity=GRAVITY):
-  def update(self, entities):
-    self.v[1] += gravity
-    klass.update(self, entities)
-
-  return extend(klass, 'fallable', update)
+  return extend(klass, 'fallable', v=Column('fallable', 'v', [0, 0]),
+                                   gravity=Column('fallable', 'gravity', gravity))
 
 @component
 def healthable(klass, health):
-  def __init__(self, *args, **kwargs):
-    klass.__init__(self, *args, **kwargs)
-    self.health = health
-
-  return extend(klass, 'healthable', __init__)
+  return extend(klass, 'healthable', health=Column('healthable', 'health', health))
 
 class Point:
   def __init__(self, x, y):
@@ -89,52 +136,144 @@ def sign(x):
   if x < 0: return -1
   return 0
 
-class BigMap:
-  def __init__(self):
-    self.contents = {}
+def surface_bytes(surf):
+  width, height = surf.get_size()
+  return width * height * surf.get_bytesize()
 
-  def keys_to_key(self, *keys):
-    return "-".join([str(x) for x in keys])
+class SheetRegistry:
+  """Every sprite sheet we use, decoded once per process (or pulled out of
+  the asset cache, see assets.py) and shared by everybody who wants a piece
+  of it. Colorized copies of whole sheets are kept too; tiles are cut out of
+  those. Namespaced functions again, like FontManager.
 
-  def put(self, value, *keys):
-    self.contents[self.keys_to_key(keys)] = value
+  Counts how many files it read and decoded, so we can see what loading
+  costs (see stats())."""
 
-  def get(self, *keys):
-    return self.contents[self.keys_to_key(keys)]
+  # file name -> the sheet as decoded from disk
+  sheets = {}
+
+  # (file name, saturation) -> the whole sheet, colorized
+  colored = {}
+
+  # The AssetCache, if Game managed to load one.
+  assets = None
+
+  reads = 0
+  decodes = 0
+  colorizes = 0
+
+  # Map builds rooms on a worker thread.
+  lock = threading.RLock()
+
+  @staticmethod
+  def use_assets(cache):
+    SheetRegistry.assets = cache
+    if cache is None:
+      return
+
+    SheetRegistry.reads += 1
+    if cache.built:
+      # Building it meant reading, decoding and colorizing everything.
+      SheetRegistry.reads += len(cache.index["stamps"])
+      SheetRegistry.decodes += len(cache.index["stamps"])
+      SheetRegistry.colorizes += len(cache.index["sheets"])
+
+  @staticmethod
+  def decoded(file_name):
+    with SheetRegistry.lock:
+      if file_name not in SheetRegistry.sheets:
+        SheetRegistry.reads += 1
+        SheetRegistry.decodes += 1
+        SheetRegistry.sheets[file_name] = spritesheet.spritesheet(file_name).sheet
+
+      return SheetRegistry.sheets[file_name]
+
+  @staticmethod
+  def sheet(file_name, saturation):
+    """All of FILE_NAME, colorized to SATURATION."""
+    key = (file_name, tuple(saturation))
 
-  def has(self, *keys):
-    return self.keys_to_key(keys) in self.contents
+    with SheetRegistry.lock:
+      if key not in SheetRegistry.colored:
+        precompiled = SheetRegistry.assets
+        if precompiled is not None and precompiled.has(file_name, saturation):
+          SheetRegistry.colored[key] = precompiled.sheet(file_name, saturation)
+        else:
+          SheetRegistry.colorizes += 1
+          SheetRegistry.colored[key] = Graphics.colorize(SheetRegistry.decoded(file_name), list(saturation))
+
+      return SheetRegistry.colored[key]
+
+  @staticmethod
+  def size(file_name):
+    """(width, height) of FILE_NAME in pixels."""
+    precompiled = SheetRegistry.assets
+    size = precompiled.size(file_name) if precompiled is not None else None
+
+    return size or SheetRegistry.decoded(file_name).get_size()
+
+  @staticmethod
+  def stats():
+    return { "reads": SheetRegistry.reads
+           , "decodes": SheetRegistry.decodes
+           , "colorizes": SheetRegistry.colorizes
+           , "sheets": len(SheetRegistry.colored)
+           }
+
+def sheet_size(file_name, img_sz):
+  """How many IMG_SZ tiles across and down FILE_NAME is."""
+  width, height = SheetRegistry.size(file_name)
+  return width / img_sz, height / img_sz
+
+# How many bytes worth of tile variants get_tilesheet_image holds on to.
+TILE_CACHE_BUDGET = 2 * 1024 * 1024
 
-#TODO: file_name -> just the "name.png" part, not the entire directory, when storing in BigMap.
 def get_tilesheet_image(file_name, pos_x, pos_y, img_sz, saturation):
+  """Returns the IMG_SZ square tile at (POS_X, POS_Y) of FILE_NAME, colorized
+  to SATURATION. Each variant is only built the first time somebody asks for
+  it."""
   assert(isinstance(saturation, list))
 
-  if not get_tilesheet_image.loaded_sheets.has(file_name, pos_x, pos_y, saturation):
-    new_sheet = spritesheet.spritesheet(file_name)
-    width, height = dimensions = new_sheet.sheet.get_size()
-    images = [[new_sheet.image_at((x, y, img_sz, img_sz), colorkey=(255,255,255))
-            for y in range(0, height, img_sz)] for x in range(0, width, img_sz)]
-
-    sat_levels = [UNCOLORED, 1]
+  key = (file_name, pos_x, pos_y, img_sz, tuple(saturation))
 
-    for r in sat_levels:
-      for g in sat_levels:
-        for b in sat_levels:
-          rgb = [r,g,b]
+  def build():
+    across, down = sheet_size(file_name, img_sz)
+    if not (0 <= pos_x < across and 0 <= pos_y < down):
+      raise KeyError(key)
 
-          # O(N^5) SUCKA!!!!! (Not really.)
+    sheet = SheetRegistry.sheet(file_name, saturation)
+    img = sheet.subsurface((pos_x * img_sz, pos_y * img_sz, img_sz, img_sz)).copy()
 
-          for img_x in range(0, width/img_sz):
-            for img_y in range(0, height/img_sz):
-              img = images[img_x][img_y]
-              get_tilesheet_image.loaded_sheets.put(Graphics.colorize(img, rgb), file_name, img_x, img_y, rgb)
+    # Same as spritesheet.image_at, except that colorize never kept the
+    # colorkey, so only uncolored tiles get one.
+    if DEBUG or min(saturation) == 1:
+      img.set_colorkey((255,255,255), pygame.RLEACCEL)
+    return img
 
-  return get_tilesheet_image.loaded_sheets.get(file_name, pos_x, pos_y, saturation)
+  with SheetRegistry.lock:
+    return get_tilesheet_image.cache.lookup(key, build)
 
-get_tilesheet_image.loaded_sheets = BigMap()
+get_tilesheet_image.cache = LRUCache(TILE_CACHE_BUDGET, weigh=surface_bytes)
 
 class Image:
-  """An image that exists in the current room. """
+  """An image that exists in the current room.
+
+  Images are drawn somewhere between where they were before the last
+  simulation step and where they are now, ALPHA of the way (see
+  Game.main_loop), so movement stays smooth when we render more often than
+  we simulate."""
+
+  # How far we are into the next simulation step, from 0 to 1.
+  alpha = 1.0
+
+  # Counts simulation steps, so images can tell whether they moved in the
+  # latest one.
+  step = 0
+
+  # Anything that moves further than this in one step (like going through a
+  # room edge) just jumps there.
+  SNAP_DISTANCE = 2 * TILE_SIZE
+
   def __init__(self, file_name, file_pos_x, file_pos_y, my_x, my_y, img_sz, saturation=None):
     if saturation is None:
       saturation = [COLORED, COLORED, COLORED]
@@ -148,6 +287,9 @@ class Image:
     self.rect.x = my_x
     self.rect.y = my_y
 
+    self.previous = (self.rect.x, self.rect.y)
+    self.moved_at = -1
+
   def xget(self):
     return self.rect.x
   
@@ -169,56 +311,179 @@ class Image:
     return (self.rect.x, self.rect.y)
 
   def set_position(self, position):
+    if self.moved_at != Image.step:
+      self.previous = (self.rect.x, self.rect.y)
+      self.moved_at = Image.step
+
     self.rect.x = position[0]
     self.rect.y = position[1]
 
+  def screen_rect(self):
+    """Where the image actually gets drawn this frame."""
+    if self.moved_at != Image.step or Image.alpha >= 1:
+      return self.rect.copy()
+
+    px, py = self.previous
+    dx, dy = self.rect.x - px, self.rect.y - py
+    if abs(dx) > Image.SNAP_DISTANCE or abs(dy) > Image.SNAP_DISTANCE:
+      return self.rect.copy()
+
+    return self.rect.move(int(round(px + dx * Image.alpha)) - self.rect.x,
+                          int(round(py + dy * Image.alpha)) - self.rect.y)
+
   def render(self, screen):
-    screen.blit(self.img, self.rect)
+    screen.blit(self.img, self.screen_rect())
 
 class EntityManager:
   """Manages all entities in the game. Each entity should inherit from
-  Entity."""
+  Entity.
+
+  Entities are kept in depth buckets (see Entity.depth), which is also the
+  order they're updated and rendered in, and are indexed by class, so
+  finding them by class doesn't need a pass over everything."""
+
   def __init__(self):
-    self.entities = []
+    # depth -> ordered set (an OrderedDict of entity -> None) of entities
+    self.buckets = {}
+    self.depths = []
+    self.entity_depths = {}
+
+    self.by_type = {}
+
+    # in_render_order(), rebuilt only after something is added or deleted.
+    self.ordered = None
+
+    # A FrameProfiler to report per-entity timings to, if we're profiling.
+    self.profiler = None
+
+    # Component data of every entity here: component name -> ComponentStore.
+    self.stores = dict((name, ComponentStore(name, fields)) for name, fields in COMPONENTS.items())
+
+  @property
+  def entities(self):
+    return self.in_render_order()
+
+  def __len__(self):
+    return len(self.entity_depths)
+
+  def __contains__(self, entity):
+    return entity in self.entity_depths
 
   def add(self, entity):
-    self.entities.append(entity)
+    depth = entity.depth() if hasattr(entity, 'depth') else -99999
+
+    if depth not in self.buckets:
+      self.buckets[depth] = OrderedDict()
+      bisect.insort(self.depths, depth)
+    self.buckets[depth][entity] = None
+    self.entity_depths[entity] = depth
+
+    for klass in type(entity).__mro__:
+      self.by_type.setdefault(klass, OrderedDict())[entity] = None
+
+    self.ordered = None
+
+    for name in getattr(type(entity), 'components', []):
+      self.stores[name].attach(entity)
 
   def update(self):
-    for entity in self.entities:
+    self.fall()
+
+    if self.profiler is not None:
+      return self.profiled("update", lambda entity: entity.update(self))
+
+    # Entities added during this loop get their first update next tick;
+    # deleted ones finish this one (nothing looks at them after that).
+    for entity in self.in_render_order():
       entity.update(self)
 
-  def render(self, screen):
-    # Sort by depth, if the entities have it.
-    self.entities = sorted(self.entities, key=lambda entity: entity.depth() if hasattr(entity, 'depth') else -99999)
+  def fall(self):
+    """The fallable system: gravity, for everything that falls, in one go."""
+    store = self.stores['fallable']
+    live = store.live
+    store.columns['v'][live, 1] += store.columns['gravity'][live]
+
+  def profiled(self, phase, step, entities=None):
+    """update() or render(), but timing each entity as we go."""
+    for entity in entities if entities is not None else self.in_render_order():
+      start = default_timer()
+      step(entity)
+      self.profiler.add_entity(phase, entity_kind(entity), default_timer() - start)
+
+  def in_render_order(self):
+    """Every entity, sorted by depth (entities without one go first). Don't
+    hang on to the list, it's shared until something is added or deleted."""
+    if self.ordered is None:
+      self.ordered = []
+      for depth in self.depths:
+        self.ordered.extend(self.buckets[depth])
+    return self.ordered
+
+  def in_depths(self, low=None, high=None):
+    """Entities with LOW <= depth < HIGH (either may be None), in render
+    order."""
+    return [entity for depth in self.depths
+                   if (low is None or depth >= low) and (high is None or depth < high)
+                   for entity in self.buckets[depth]]
+
+  def render(self, screen, low=None, high=None):
+    """Renders everything, or only the entities with LOW <= depth < HIGH."""
+    if low is None and high is None:
+      entities = self.in_render_order()
+    else:
+      entities = self.in_depths(low, high)
 
-    for entity in self.entities:
+    if self.profiler is not None:
+      return self.profiled("render", lambda entity: entity.render(screen), entities)
+
+    for entity in entities:
       entity.render(screen)
 
   def get_one(self, func):
-    results = [entity for entity in self.entities if func(entity)]
+    results = [entity for entity in self.in_render_order() if func(entity)]
     assert len(results) == 1
     return results[0]
 
   def get_all(self, func):
-    return [entity for entity in self.entities if func(entity)]
+    return [entity for entity in self.in_render_order() if func(entity)]
+
+  def get_one_of(self, klass):
+    """The one and only entity that's an instance of KLASS."""
+    results = self.by_type.get(klass, {})
+    assert len(results) == 1
+    return next(iter(results))
+
+  def get_all_of(self, klass):
+    return list(self.by_type.get(klass, []))
 
   def delete(self, obj):
-    self.delete_all(lambda e: obj == e)
+    if obj not in self.entity_depths:
+      return
+
+    depth = self.entity_depths.pop(obj)
+    del self.buckets[depth][obj]
+
+    for klass in type(obj).__mro__:
+      del self.by_type[klass][obj]
+
+    self.ordered = None
+
+    for store in self.stores.values():
+      store.detach(obj)
 
   def delete_all(self, func):
     """Delete all enetities E such that func(E) == True """
 
-    entities_remaining = []
-    for entity in self.entities:
-      if not func(entity):
-        entities_remaining.append(entity)
-
-    self.entities = entities_remaining
+    for entity in self.get_all(func):
+      self.delete(entity)
 
 class Entity(object):
   components = []
 
+  # Whether this is drawn over the world rather than being part of it (the
+  # HUD, dialog...). Game.checksum leaves overlays out.
+  overlay = False
+
   @classmethod
   def has(cls, a):
     return a in cls.components
@@ -258,6 +523,25 @@ class Entity(object):
   def render(self, screen):
     raise NotImplementedException
 
+  def bounds(self):
+    """Where on screen render() draws: a Rect, a list of Rects, or None for
+    things that are part of the background (see DirtyRectRenderer)."""
+    return pygame.Rect(self.x, self.y, self.size, self.size)
+
+  def appearance(self):
+    """Whatever, besides bounds(), decides what render() draws: text, a
+    color, a frame... DirtyRectRenderer redraws the entity whenever this
+    changes, so anything that can change in place has to show up here."""
+    return None
+
+def entity_kind(entity):
+  """The name of ENTITY's class, looking past the subclasses that components
+  (see extend) wrap around it."""
+  klass = type(entity)
+  while klass.__name__ in getattr(klass, 'components', []):
+    klass = klass.__bases__[0]
+  return klass.__name__
+
 def bound(num, asymptote):
   a = abs(asymptote)
   if num < -a:
@@ -289,36 +573,171 @@ class HUDIcon(Entity):
     else:
       self.desat_img.render(screen)
 
-class Fireball(Entity):
-  def __init__(self, creator, direction):
-    Entity.__init__(self, creator.x, creator.y, TILE_SIZE / 4)
+  def bounds(self):
+    return self.img.screen_rect()
+
+  def appearance(self):
+    return self.is_saturated
+
+class Fireballs(Entity):
+  """Every fireball there is, as one entity. Positions and velocities live in
+  arrays (one slot per fireball, with a free list so dead fireballs' slots
+  get reused), so each tick moves and wall-tests all of them at once and
+  draws them with a single blit_all call. Fine with thousands of them flying
+  around.
+
+  Fireballs fly in a straight line and burn out when they hit a wall or
+  leave the room."""
 
-    global g_saturation
-    self.img = Image("sprites.png", 0, 1, self.x, self.y, TILE_SIZE, g_saturation)
-    self.speed = 5
+  SPEED = 5
 
-    self.dx, self.dy = [delta * self.speed for delta in direction]
-    print self.dx, self.dy
+  # Past this many fireballs, bounds() gives one rect around all of them
+  # rather than making DirtyRectRenderer merge thousands of little ones.
+  MAX_BOUNDS = 32
+
+  def __init__(self, map, capacity=64):
+    Entity.__init__(self, 0, 0, TILE_SIZE / 4)
+
+    self.map = map
+    self.ticks = 0
+
+    self.xs = N.zeros(capacity)
+    self.ys = N.zeros(capacity)
+    self.dxs = N.zeros(capacity)
+    self.dys = N.zeros(capacity)
+
+    # Where each fireball was drawn before the latest step, for
+    # interpolation (see Image.screen_rect).
+    self.previous_xs = N.zeros(capacity, dtype=int)
+    self.previous_ys = N.zeros(capacity, dtype=int)
+
+    # The tick each fireball was thrown on; they start moving the tick after.
+    self.born = N.zeros(capacity, dtype=int)
+
+    # The saturation each fireball was thrown in, as R * 4 + G * 2 + B. They
+    # keep it, like any other sprite.
+    self.tints = N.zeros(capacity, dtype=N.uint8)
+    self.alive = N.zeros(capacity, dtype=bool)
+    self.free = range(capacity - 1, -1, -1)
+
+  def __len__(self):
+    return int(N.count_nonzero(self.alive))
+
+  def grow(self):
+    old = len(self.alive)
+
+    for name in ["xs", "ys", "dxs", "dys", "previous_xs", "previous_ys", "born", "tints", "alive"]:
+      array = getattr(self, name)
+      setattr(self, name, N.concatenate([array, N.zeros_like(array)]))
+
+    self.free = range(2 * old - 1, old - 1, -1) + self.free
+
+  def spawn(self, x, y, direction):
+    """Throws a fireball from (X, Y) in DIRECTION (LEFT, RIGHT, ...)."""
+    if not self.free:
+      self.grow()
+
+    i = self.free.pop()
+    self.xs[i] = x
+    self.ys[i] = y
+    self.dxs[i] = direction[0] * self.SPEED
+    self.dys[i] = direction[1] * self.SPEED
+    self.previous_xs[i] = int(x)
+    self.previous_ys[i] = int(y)
+    self.born[i] = self.ticks
+    r, g, b = world_saturation()
+    self.tints[i] = r * 4 + g * 2 + b
+    self.alive[i] = True
 
   def update(self, entities):
-    self.x += self.dx
-    self.y += self.dy
+    live = N.flatnonzero(self.alive)
+    self.previous_xs[live] = self.xs[live].astype(int)
+    self.previous_ys[live] = self.ys[live].astype(int)
 
-    self.img.set_position((self.x, self.y))
+    # The ones thrown this tick (by Character, which updates before us) wait
+    # until next tick, same as any new entity.
+    moving = live[self.born[live] < self.ticks]
+    self.ticks += 1
 
-    if len(entities.get_all(lambda e: hasattr(e, "wall") and e.wall and self.touches_entity(e))) > 0:
-      entities.delete(self)
+    if len(moving) == 0:
+      return
+
+    xs, ys, hit = self.map.sweep_many(self.xs[moving], self.ys[moving], self.size, self.size,
+                                      self.dxs[moving], self.dys[moving])
+    self.xs[moving] = xs
+    self.ys[moving] = ys
+
+    outside = (xs < 0) | (xs > MAP_IN_PX) | (ys < 0) | (ys > MAP_IN_PX)
+    dead = moving[hit | outside]
+
+    self.alive[dead] = False
+    self.free.extend(dead.tolist())
 
-    if not self.in_bounds():
-      entities.delete(self)
-  
   def depth(self):
     return 10
 
+  def screen_positions(self):
+    """Where each live fireball gets drawn this frame, as two int arrays."""
+    live = N.flatnonzero(self.alive)
+    xs = self.xs[live].astype(int)
+    ys = self.ys[live].astype(int)
+
+    if Image.alpha >= 1:
+      return xs, ys
+
+    px, py = self.previous_xs[live], self.previous_ys[live]
+    dx, dy = xs - px, ys - py
+
+    # Same as Image.screen_rect, for all of them at once. N.round rounds
+    # halves to even, where round() rounds them away from zero.
+    half_up = lambda v: (N.sign(v) * N.floor(N.abs(v) + 0.5)).astype(int)
+
+    snap = (N.abs(dx) > Image.SNAP_DISTANCE) | (N.abs(dy) > Image.SNAP_DISTANCE)
+    ix = N.where(snap, xs, half_up(px + dx * Image.alpha))
+    iy = N.where(snap, ys, half_up(py + dy * Image.alpha))
+    return ix, iy
+
+  @staticmethod
+  def image(tint):
+    saturation = [(tint >> 2) & 1, (tint >> 1) & 1, tint & 1]
+    return get_tilesheet_image(SPRITE_DIR + "sprites.png", 0, 1, TILE_SIZE, saturation)
+
   def render(self, screen):
-    self.img.render(screen)
+    if not self.alive.any():
+      return
+
+    tints = self.tints[self.alive].tolist()
+    images = dict((tint, Fireballs.image(tint)) for tint in set(tints))
+
+    xs, ys = self.screen_positions()
+    sequence = [(images[tint], position) for tint, position in zip(tints, zip(xs.tolist(), ys.tolist()))]
+
+    blit_all(screen, sequence)
+
+  def bounds(self):
+    if not self.alive.any():
+      return None
+
+    xs, ys = self.screen_positions()
+    width, height = TILE_SIZE, TILE_SIZE
+
+    if len(xs) > self.MAX_BOUNDS:
+      return pygame.Rect(xs.min(), ys.min(), xs.max() - xs.min() + width, ys.max() - ys.min() + height)
+
+    return [pygame.Rect(x, y, width, height) for x, y in zip(xs.tolist(), ys.tolist())]
+
+  def appearance(self):
+    # Past MAX_BOUNDS the bounds are one big rect, which fireballs can move
+    # around in without changing it.
+    if not self.alive.any():
+      return None
+
+    xs, ys = self.screen_positions()
+    return (xs.tostring(), ys.tostring(), self.tints[self.alive].tostring())
 
 class HeadsUpDisplay(Entity):
+  overlay = True
+
   def __init__(self, character):
     Entity.__init__(self, 0, 0, MAP_IN_PX)
     self.width = self.height = MAP_IN_PX
@@ -341,6 +760,12 @@ class HeadsUpDisplay(Entity):
     for component in self.components:
       component.render(screen)
 
+  def bounds(self):
+    return [component.bounds() for component in self.components]
+
+  def appearance(self):
+    return [component.appearance() for component in self.components]
+
   def depth(self):
     return 100
 
@@ -363,46 +788,15 @@ class Character(Entity):
     #colors turned on
     self.colors_on = [False, False, True]
 
-    self.sprite = Image("tiles.png", 0, 0, self.x, self.y, TILE_SIZE, g_saturation)
+    self.sprite = Image("tiles.png", 0, 0, self.x, self.y, TILE_SIZE, world_saturation())
 
-  def touching_wall(self, entities):
-    return len(entities.get_all(lambda e: hasattr(e, "wall") and e.wall and self.touches_entity(e))) > 0
+  def touching_ground(self, map):
+    # We always stop SKIN short of walls, so look that far down.
+    return map.sweep(self.x, self.y, self.size, self.size, 0, SKIN)[2][1] != 0
 
-  def touching_ground(self, entities):
-    feet = [ Point(self.x +             2, self.y + self.size)
-           , Point(self.x + self.size - 2, self.y + self.size)
-           ]
+  def in_water(self, map):
+    return map.box_has(WATER, self.x, self.y, self.size, self.size)
 
-    for foot in feet:
-      if len(entities.get_all(lambda e: hasattr(e, "wall") and e.wall and e.touches_point(foot))) > 0:
-        return True
-
-    return False
-
-  def in_water(self, entities):
-    return len(entities.get_all(lambda e: hasattr(e, "water") and e.water and self.touches_entity(e))) > 0
-
-  def resolve_collision(self, entities, vx, vy):
-    assert not (vx != 0 and vy != 0) #Doing both at once is bad!
-
-    had_collision = False
-
-    # Design note: we could abstract this into v[0] and v[1] and not dupe this
-    # code; however I feel that v[0] is harder to understand and the actual
-    # amount of duped code is small.
-
-    while self.touching_wall(entities) and abs(vy) > 0:
-      had_collision = True
-      self.y -= bound(vy, 1)
-      vy -= bound(vy, 1)
-
-    while self.touching_wall(entities) and abs(vx) > 0:
-      had_collision = True
-      self.x -= bound(vx, 1)
-      vx -= bound(vx, 1)
-
-    return had_collision
-  
   def update_facing_position(self, keys):
     if keys[pygame.K_RIGHT]:
       self.direction = RIGHT
@@ -415,16 +809,16 @@ class Character(Entity):
 
   def do_action(self, entities):
     if self.colors_on[RED]:
-      entities.add(Fireball(self, self.direction))
+      entities.get_one_of(Fireballs).spawn(self.x, self.y, self.direction)
 
   def update(self, entities):
-    keys = pygame.key.get_pressed()
+    map = entities.get_one_of(Map)
+
+    keys = Input.get_pressed()
     self.update_facing_position(keys)
     if keys[pygame.K_x]:
       self.do_action(entities)
 
-    map = entities.get_one(lambda e: isinstance(e, Map))
-
     vx = (keys[pygame.K_RIGHT] - keys[pygame.K_LEFT]) * self.side_accel
     if vx == 0 or sign(vx) + sign(self.v[0]) == 0:
       self.v[0] *= self.decel[0]
@@ -435,13 +829,15 @@ class Character(Entity):
 
     self.v[1] -= keys[pygame.K_z] * self.jump_height if self.on_ground else 0
 
-    if self.in_water(entities) and self.colors_on[BLUE]:
+    if self.in_water(map) and self.colors_on[BLUE]:
       self.v[1] += self.swim_speed * (keys[pygame.K_DOWN] - keys[pygame.K_UP])
       self.v[1] *= .6 #decel
     else:
       self.v[1] += GRAVITY
 
-    self.x += self.v[0]
+    self.x, _, normal = map.sweep(self.x, self.y, self.size, self.size, self.v[0], 0)
+    if normal[0] != 0:
+      self.v[0] = 0
 
     map_dx = int(math.floor(self.x / map.size))
 
@@ -449,20 +845,16 @@ class Character(Entity):
       map.new_map(entities, map_dx, 0, rel=True)
       self.x -= map_dx * map.size
 
-    if self.resolve_collision(entities, self.v[0], 0):
-      self.v[0] = 0
-
-    self.y += self.v[1]
+    _, self.y, normal = map.sweep(self.x, self.y, self.size, self.size, 0, self.v[1])
+    if normal[1] != 0:
+      self.v[1] = 0
 
     map_dy = int(math.floor(self.y / map.size))
     if map_dy != 0:
       map.new_map(entities, 0, map_dy, rel=True)
       self.x -= map_dx * map.size
 
-    self.on_ground = self.touching_ground(entities)
-
-    if self.resolve_collision(entities, 0, self.v[1]):
-      self.v[1] = 0
+    self.on_ground = self.touching_ground(map)
 
     self.sprite.set_position((self.x,self.y))
 
@@ -473,9 +865,7 @@ class Character(Entity):
     # Toggle red platforms.
     # Eh, I get the feeling like this shouldn't be tangled up in Character...
     if color == RED:
-      red_platforms = entities.get_all(lambda e: hasattr(e, "redplatform") and e.redplatform)
-      for platform in red_platforms:
-        platform.wall = not platform.wall
+      entities.get_one_of(Map).toggle_red_platforms()
 
 
   def check_mutations(self, keys, entities):
@@ -496,43 +886,158 @@ class Character(Entity):
   def render(self, screen):
     self.sprite.render(screen)
 
+  def bounds(self):
+    return self.sprite.screen_rect()
+
   def depth(self):
     return 0
 
-class Tile(Entity):
-  def type_to_image(self, type):
-    global g_saturation
-    if type == (0, 0, 0):
-      self.wall = True
-      return Image("tiles.png", 1, 0, 30, 30, TILE_SIZE, g_saturation)
-    elif type == (255, 255, 255):
-      return Image("tiles.png", 0, 1, 30, 30, TILE_SIZE, g_saturation)
-    elif type == (0, 0, 255):
-      self.water = True
-      return Image("tiles.png", 1, 1, 30, 30, TILE_SIZE, g_saturation)
-    elif type == (255, 0, 0):
-      self.redplatform = True
-      self.wall = True
-      return Image("tiles.png", 1, 1, 30, 30, TILE_SIZE, g_saturation)
+def flag_property(flag):
+  """A boolean attribute backed by one bit of self.grid[self.cell]."""
+  def get(self):
+    return bool(self.grid[self.cell] & flag)
+
+  def set(self, value):
+    if value:
+      self.grid[self.cell] |= flag
     else:
-      raise NoSuchTileException
+      self.grid[self.cell] &= 0xFF ^ flag
 
-  def __init__(self, position, type, size):
-    Entity.__init__(self, position[0], position[1], size)
+  return property(get, set)
 
-    self.sprite = self.type_to_image(type)
-    self.sprite.set_position(position)
+class NoSuchTileException(Exception):
+  pass
 
-  def get_position(self): 
-    return self.sprite.get_position()
+class Tile(object):
+  """One cell of a room, as a view onto the room's arrays: its kind lives in
+  room.kinds and its wall/water/redplatform flags in room.grid, so flipping
+  a bit there is all it takes to change it. Cheap to make and throw away;
+  rooms don't keep these around."""
 
-  def update(self, entities):
-    pass
+  __slots__ = ("room", "cell", "size")
 
-  def render(self, screen):
-    self.sprite.render(screen)
+  # Color in map.png -> (flags, position of the tile's image in tiles.png)
+  TYPES = { (0, 0, 0)       : (WALL,               (1, 0))
+          , (255, 255, 255) : (0,                  (0, 1))
+          , (0, 0, 255)     : (WATER,              (1, 1))
+          , (255, 0, 0)     : (WALL | REDPLATFORM, (1, 1))
+          }
+
+  # Rooms store tiles by their index in here (their "kind") rather than by
+  # color.
+  KINDS = sorted(TYPES.keys())
+  KIND_FLAGS = N.array([TYPES[type][0] for type in KINDS], dtype=N.uint8)
+
+  @staticmethod
+  def flags_for(type):
+    if type not in Tile.TYPES:
+      raise NoSuchTileException(type)
+    return Tile.TYPES[type][0]
+
+  @staticmethod
+  def kinds_of(pixels):
+    """The kind of every pixel in PIXELS (a surfarray.array3d) as a tile."""
+    # Every pixel packed into one int, so we can match whole colors at once.
+    colors = (pixels[..., 0].astype(N.int32) << 16) | (pixels[..., 1].astype(N.int32) << 8) | pixels[..., 2]
+
+    kinds = N.zeros(colors.shape, dtype=N.uint8)
+    known = N.zeros(colors.shape, dtype=bool)
+
+    for kind, (r, g, b) in enumerate(Tile.KINDS):
+      matches = colors == ((r << 16) | (g << 8) | b)
+      kinds[matches] = kind
+      known |= matches
+
+    if not known.all():
+      x, y = N.argwhere(~known)[0]
+      raise NoSuchTileException(tuple(pixels[x, y]))
+
+    return kinds
+
+  @staticmethod
+  def kind_image(kind, saturation):
+    img_x, img_y = Tile.TYPES[Tile.KINDS[kind]][1]
+    return get_tilesheet_image(SPRITE_DIR + "tiles.png", img_x, img_y, TILE_SIZE, saturation)
+
+  def __init__(self, room, cell, size):
+    self.room = room
+    self.cell = cell
+    self.size = size
+
+  @property
+  def grid(self):
+    return self.room.grid
+
+  @property
+  def kind(self):
+    return self.room.kinds[self.cell]
+
+  @property
+  def type(self):
+    return Tile.KINDS[self.kind]
+
+  @property
+  def x(self):
+    return self.cell[0] * self.size
+
+  @property
+  def y(self):
+    return self.cell[1] * self.size
+
+  wall = flag_property(WALL)
+  water = flag_property(WATER)
+  redplatform = flag_property(REDPLATFORM)
+
+  def get_position(self):
+    return (self.x, self.y)
+
+  def image(self, saturation):
+    return Tile.kind_image(self.kind, saturation)
+
+class Room:
+  """Everything Map needs to show one room: what kind of tile is in each
+  cell (an index into Tile.KINDS), their occupancy grid and the layer
+  they're baked into (at LAYER_SATURATION). KINDS and GRID are both
+  indexed [x, y].
+
+  Map edits the grid and layer in place while the room is current, so a
+  cached Room always has whatever happened to it last time we were there."""
+
+  def __init__(self, mapx, mapy, kinds, grid, layer, layer_saturation):
+    self.mapx = mapx
+    self.mapy = mapy
+    self.kinds = kinds
+    self.grid = grid
+    self.layer = layer
+    self.layer_saturation = layer_saturation
+
+    # Red platforms start out solid, straight out of map.png.
+    self.redplatforms_solid = True
+
+  def open_cells(self):
+    """Every cell (x, y) without a wall in it, column by column."""
+    xs, ys = N.nonzero((self.grid & WALL) == 0)
+    return zip(xs.tolist(), ys.tolist())
 
 class Map(Entity):
+  # Once the character is this close to the edge of the room, we start
+  # building the room on the other side in the background.
+  PREFETCH_MARGIN = 3 * TILE_SIZE
+
+  # How many built rooms to keep around. A room is mostly its 400x400
+  # layer, so this is about 10MB.
+  ROOM_CACHE_SIZE = 16
+
+  # Only one thread at a time makes or draws into a layer: SDL surfaces
+  # aren't thread safe (tile images get RLE-encoded on their first blit,
+  # say), so the prefetch thread does all of that under this.
+  bake_lock = threading.Lock()
+
+  # One thread builds prefetched rooms for every Map, started the first
+  # time anything gets prefetched. It's fed (map, (mapx, mapy)).
+  prefetch_queue = None
+  prefetch_thread = None
+
   def __init__(self, img_sz, map_sz, file_name):
     self.mapx = None
     self.mapy = None
@@ -540,14 +1045,111 @@ class Map(Entity):
     self.img_sz = img_sz
     self.map_sz = map_sz
     self.file_name = file_name
+    self.grid = None
+
+    # A world file (see world.py) gets read room by room, straight from
+    # disk. Anything else is an image with a pixel per tile.
+    self.world = None
+    if file_name.endswith(world.EXTENSION):
+      self.world = world.World(os.path.join(MAP_DIR, file_name))
+      if self.world.room_size != map_sz:
+        raise ValueError("%s has %d tile rooms, not %d" % (file_name, self.world.room_size, map_sz))
+      if self.world.kinds != [tuple(kind) for kind in Tile.KINDS]:
+        raise ValueError("%s was made with other tiles; convert it again" % file_name)
+    self.kinds = None
+    self.room = None
+
+    # Whether red platforms are walls right now. Rooms we haven't been to in
+    # a while get brought in line with this when they come back.
+    self.redplatforms_solid = True
+
+    self.room_cache = LRUCache(self.ROOM_CACHE_SIZE)
 
     Entity.__init__(self, 0, 0, img_sz * map_sz)
 
+    # Every tile of the room, pre-drawn. Rebuilt when the room or
+    # g_saturation changes; single cells get redrawn through invalidate().
+    self.layer = pygame.Surface((self.size, self.size)).convert()
+    self.layer_saturation = None
+    self.dirty_cells = set()
+
+    # Parts of the layer redrawn since the last take_changed_rects(). Only
+    # kept track of when something takes them (see DirtyRectRenderer), or
+    # nothing would ever empty the list.
+    self.track_changes = False
+    self.changed_rects = []
+
+    # Rooms built (or being built) by the prefetch thread, by (mapx, mapy).
+    self.prefetched = {}
+    self.pending = set()
+    self.prefetch_done = threading.Condition()
+
+  def rooms(self):
+    """How many rooms across and down the whole map is."""
+    if self.world is not None:
+      return self.world.rooms()
+    return sheet_size(os.path.join(MAP_DIR, self.file_name), self.map_sz)
+
   def update(self, entities):
-    pass
+    character = entities.get_one_of(Character)
+
+    if character.x < self.PREFETCH_MARGIN:
+      self.prefetch(self.mapx - 1, self.mapy)
+    if character.x > self.size - self.PREFETCH_MARGIN:
+      self.prefetch(self.mapx + 1, self.mapy)
+    if character.y < self.PREFETCH_MARGIN:
+      self.prefetch(self.mapx, self.mapy - 1)
+    if character.y > self.size - self.PREFETCH_MARGIN:
+      self.prefetch(self.mapx, self.mapy + 1)
+
+  def invalidate(self, cell=None):
+    """Redraw CELL of the layer next time we render, or all of it if CELL is
+    None."""
+    if cell is None:
+      self.layer_saturation = None
+    else:
+      self.dirty_cells.add(cell)
+
+  def bake_cells(self, layer, kinds, cells, saturation):
+    """Draws CELLS of LAYER. Hold Map.bake_lock."""
+    sz = self.img_sz
+
+    # Look every kind of tile up once, not every cell.
+    images = [Tile.kind_image(kind, saturation) for kind in range(len(Tile.KINDS))]
+
+    for x, y in cells:
+      layer.fill((0, 0, 0), (x * sz, y * sz, sz, sz))
+      layer.blit(images[kinds[x, y]], (x * sz, y * sz))
+
+  def all_cells(self):
+    return [(x, y) for x in range(self.map_sz) for y in range(self.map_sz)]
+
+  def bake(self):
+    if self.layer_saturation != world_saturation():
+      self.layer_saturation = world_saturation()[:]
+      self.dirty_cells = set(self.all_cells())
+      self.changed_rects = [pygame.Rect(self.x, self.y, self.size, self.size)]
+
+    with Map.bake_lock:
+      self.bake_cells(self.layer, self.kinds, self.dirty_cells, self.layer_saturation)
+
+    if self.track_changes:
+      for cell in self.dirty_cells:
+        self.changed_rects.append(pygame.Rect(self.x + cell[0] * self.img_sz, self.y + cell[1] * self.img_sz,
+                                              self.img_sz, self.img_sz))
+    self.dirty_cells = set()
+
+  def take_changed_rects(self):
+    rects = self.changed_rects
+    self.changed_rects = []
+    return rects
 
   def render(self, screen):
-    pass
+    self.bake()
+    screen.blit(self.layer, (self.x, self.y))
+
+  def bounds(self):
+    return None
 
   def new_map(self, entity_manager, x, y, **kwargs):
     assert isinstance(x, int)
@@ -564,26 +1166,294 @@ class Map(Entity):
       self.mapx = x
       self.mapy = y
 
-    self.map_data = get_tilesheet_image(MAP_DIR + self.file_name, self.mapx, self.mapy, self.map_sz, [1,1,1])
+    room = self.room_cache.get((self.mapx, self.mapy))
+    if room is None:
+      room = self.take_prefetched(self.mapx, self.mapy)
+    if room is None:
+      room = self.build_room(self.mapx, self.mapy)
+
+    self.install(room, entity_manager)
+
+  def build_room(self, mapx, mapy):
+    """Builds room (MAPX, MAPY) from scratch. Safe to call off the main
+    thread: it doesn't touch the Map or any entities."""
+    if self.world is not None:
+      kinds = self.world.room_kinds(mapx, mapy)
+      grid = Tile.KIND_FLAGS[kinds]
+    else:
+      map_data = get_tilesheet_image(os.path.join(MAP_DIR, self.file_name), mapx, mapy, self.map_sz, [1,1,1])
+      kinds, grid = self.make_map(map_data)
+
+    saturation = world_saturation()[:]
+    with Map.bake_lock:
+      layer = pygame.Surface((self.size, self.size)).convert()
+      self.bake_cells(layer, kinds, self.all_cells(), saturation)
+
+    return Room(mapx, mapy, kinds, grid, layer, saturation)
+
+  def install(self, room, entity_manager):
+    """Makes ROOM the current room."""
+    if self.room is not None:
+      # Cells still waiting to be redrawn would be forgotten; redraw the
+      # whole thing next time instead.
+      if self.dirty_cells:
+        self.room.layer_saturation = None
+      else:
+        self.room.layer_saturation = self.layer_saturation
+
+    self.room = room
+    self.room_cache.put((room.mapx, room.mapy), room)
+
+    self.kinds = room.kinds
+    self.grid = room.grid
+    self.layer = room.layer
+    self.layer_saturation = room.layer_saturation
+    self.dirty_cells = set()
+    self.changed_rects = [pygame.Rect(self.x, self.y, self.size, self.size)]
+
+    self.match_red_platforms()
+
+    # Whatever we prefetched that isn't next door anymore won't be needed.
+    with self.prefetch_done:
+      for mapx, mapy in self.prefetched.keys():
+        if abs(mapx - self.mapx) + abs(mapy - self.mapy) > 1:
+          del self.prefetched[(mapx, mapy)]
+
+  def prefetch(self, mapx, mapy):
+    """Starts building room (MAPX, MAPY) in the background, unless it's
+    already built, being built, or off the edge of the map."""
+    rooms_across, rooms_down = self.rooms()
+    if not (0 <= mapx < rooms_across and 0 <= mapy < rooms_down):
+      return
+
+    key = (mapx, mapy)
+    if key in self.room_cache:
+      return
+
+    with self.prefetch_done:
+      if key in self.prefetched or key in self.pending:
+        return
+      self.pending.add(key)
+
+    if Map.prefetch_thread is None:
+      Map.prefetch_queue = Queue.Queue()
+      Map.prefetch_thread = threading.Thread(target=Map.prefetch_worker, args=(Map.prefetch_queue,))
+      Map.prefetch_thread.daemon = True
+      Map.prefetch_thread.start()
+
+    Map.prefetch_queue.put((self, key))
+
+  @staticmethod
+  def stop_prefetching():
+    """Waits for the prefetch thread to build whatever it was asked to and
+    go. The next prefetch starts a new one."""
+    if Map.prefetch_thread is None:
+      return
+
+    Map.prefetch_queue.put(None)
+    Map.prefetch_thread.join()
+    Map.prefetch_queue = Map.prefetch_thread = None
+
+  @staticmethod
+  def prefetch_worker(queue):
+    while True:
+      job = queue.get()
+      if job is None:
+        return
+
+      map, key = job
+      try:
+        room = map.build_room(*key)
+      except Exception:
+        # new_map will build it again itself if we get there, but say what
+        # went wrong now.
+        sys.stderr.write("Couldn't prefetch room %s:\n%s" % (key, traceback.format_exc()))
+        room = None
+
+      with map.prefetch_done:
+        map.pending.discard(key)
+        if room is not None:
+          map.prefetched[key] = room
+        map.prefetch_done.notify_all()
+
+  def take_prefetched(self, mapx, mapy):
+    """The prefetched room (MAPX, MAPY), waiting for it if it's still being
+    built, or None if it wasn't prefetched."""
+    key = (mapx, mapy)
+    with self.prefetch_done:
+      while key in self.pending:
+        self.prefetch_done.wait()
+      return self.prefetched.pop(key, None)
+
+  def make_map(self, room_data):
+    """Tile kinds and occupancy grid (both indexed [x, y]) for the room whose
+    pixels are in ROOM_DATA."""
+    pixels = pygame.surfarray.array3d(room_data)[:self.map_sz, :self.map_sz]
+    kinds = Tile.kinds_of(pixels)
+    grid = Tile.KIND_FLAGS[kinds]
+
+    return kinds, grid
+
+  def tile(self, x, y):
+    """The tile in cell (X, Y) of the current room."""
+    return Tile(self.room, (x, y), self.img_sz)
+
+  def cells_touching(self, x, y, width, height):
+    """Range of grid cells (x0, x1, y0, y1, inclusive) whose tiles touch the
+    box at (X, Y). Like everything else, boxes include their edges. Parts of
+    the box outside the room are dropped."""
+    sz = float(self.img_sz)
+    x0 = max(int(math.ceil(x / sz)) - 1, 0)
+    y0 = max(int(math.ceil(y / sz)) - 1, 0)
+    x1 = min(int(math.floor((x + width) / sz)), self.map_sz - 1)
+    y1 = min(int(math.floor((y + height) / sz)), self.map_sz - 1)
+    return x0, x1, y0, y1
+
+  def box_has(self, flag, x, y, width, height):
+    """Whether any tile touching the box has FLAG (WALL, WATER, ...) set."""
+    x0, x1, y0, y1 = self.cells_touching(x, y, width, height)
+    if x0 > x1 or y0 > y1:
+      return False
+
+    return bool(N.any(self.grid[x0:x1 + 1, y0:y1 + 1] & flag))
+
+  def sweep(self, x, y, width, height, dx, dy):
+    """Moves the box at (X, Y) by (DX, DY), x first and then y, stopping SKIN
+    short of the first wall in the way. Every wall between here and there is
+    checked, so nothing tunnels through walls no matter how fast it goes.
+
+    Returns (x, y, normal), where normal is the contact normal of whatever we
+    hit ([0, 0] if nothing, [-1, 0] if we ran into a wall on our right, and so
+    on). Walls we're already touching when we start don't stop us, so things
+    can always get out of a wall that appeared on top of them."""
+    normal = [0, 0]
+
+    if dx != 0:
+      x, hit = self.sweep_axis(0, x, width, dx, y, height)
+      if hit:
+        normal[0] = -sign(dx)
+
+    if dy != 0:
+      y, hit = self.sweep_axis(1, y, height, dy, x, width)
+      if hit:
+        normal[1] = -sign(dy)
+
+    return x, y, normal
+
+  def sweep_many(self, x, y, width, height, dx, dy):
+    """sweep for a whole batch of boxes, all WIDTH by HEIGHT, at once. X, Y,
+    DX and DY are arrays. Returns (x, y, hit), where hit says which boxes
+    ran into a wall on either axis."""
+    x, hit_x = self.sweep_axis_many(0, x, width, dx, y, height)
+    y, hit_y = self.sweep_axis_many(1, y, height, dy, x, width)
+    return x, y, hit_x | hit_y
+
+  def sweep_axis_many(self, axis, pos, length, delta, cross, cross_length):
+    """sweep_axis for arrays of boxes. Walks every box's lane in lockstep, so
+    it costs as many numpy passes as the longest lane has cells, however
+    many boxes there are."""
+    sz = float(self.img_sz)
+    last_cell = self.map_sz - 1
+
+    new_pos = pos + delta
+    hit = N.zeros(len(pos), dtype=bool)
+    if len(pos) == 0:
+      return new_pos, hit
+
+    # walls[i, c]: is there a wall at lane cell i, cross cell c?
+    walls = (self.grid & WALL) != 0
+    if axis == 1:
+      walls = walls.T
+
+    c0 = N.maximum(N.ceil(cross / sz).astype(int) - 1, 0)
+    c1 = N.minimum(N.floor((cross + cross_length) / sz).astype(int), last_cell)
+
+    # The cells sweep_axis would look at, nearest first, clipped to the room.
+    forward = delta > 0
+    step = N.where(forward, 1, -1)
+    lead = N.where(forward, pos + length, pos)
+    first = N.where(forward, N.floor(lead / sz) + 1, N.ceil(lead / sz) - 2).astype(int)
+    last = N.where(forward, N.floor((lead + delta) / sz), N.ceil((lead + delta) / sz) - 1).astype(int)
+    start = N.where(forward, N.maximum(first, 0), N.minimum(first, last_cell))
+    stop = N.where(forward, N.minimum(last, last_cell), N.maximum(last, 0))
+
+    moving = (delta != 0) & (c0 <= c1)
+    count = N.where(moving, (stop - start) * step + 1, 0)
+    spans = c1 - c0 + 1
+
+    for j in range(count.max()):
+      i = start + j * step
+      looking = (j < count) & ~hit
+      if not looking.any():
+        break
+
+      lane = N.clip(i, 0, last_cell)
+      blocked = N.zeros(len(pos), dtype=bool)
+      for k in range(spans.max()):
+        blocked |= (k < spans) & walls[lane, N.clip(c0 + k, 0, last_cell)]
+
+      stopped = looking & blocked
+      against = N.where(forward, N.maximum(pos, i * sz - length - SKIN), N.minimum(pos, (i + 1) * sz + SKIN))
+      new_pos = N.where(stopped, against, new_pos)
+      hit |= stopped
+
+    return new_pos, hit
+
+  def sweep_axis(self, axis, pos, length, delta, cross, cross_length):
+    """sweep along one axis (0 = x, 1 = y). POS and LENGTH describe the box on
+    that axis, CROSS and CROSS_LENGTH on the other one. Returns the new
+    position and whether we hit anything."""
+    sz = float(self.img_sz)
+
+    c0 = max(int(math.ceil(cross / sz)) - 1, 0)
+    c1 = min(int(math.floor((cross + cross_length) / sz)), self.map_sz - 1)
+    if c0 > c1:
+      return pos + delta, False
+
+    # solid[i]: is there a wall in the i-th column (or row) of our lane?
+    if axis == 0:
+      solid = N.any(self.grid[:, c0:c1 + 1] & WALL, axis=1)
+    else:
+      solid = N.any(self.grid[c0:c1 + 1, :] & WALL, axis=0)
+
+    if delta > 0:
+      lead = pos + length
+      first = int(math.floor(lead / sz)) + 1
+      last = int(math.floor((lead + delta) / sz))
+
+      for i in range(max(first, 0), min(last, self.map_sz - 1) + 1):
+        if solid[i]:
+          return max(pos, i * sz - length - SKIN), True
+    else:
+      lead = pos
+      first = int(math.ceil(lead / sz)) - 2
+      last = int(math.ceil((lead + delta) / sz)) - 1
 
-    entity_manager.delete_all(lambda e: isinstance(e, Tile))
+      for i in range(min(first, self.map_sz - 1), max(last, 0) - 1, -1):
+        if solid[i]:
+          return min(pos, (i + 1) * sz + SKIN), True
 
-    self.map = self.make_map()
+    return pos + delta, False
 
-    for tile_row in self.map:
-      for tile in tile_row:
-        entity_manager.add(tile)
+  def toggle_red_platforms(self):
+    self.redplatforms_solid = not self.redplatforms_solid
+    self.match_red_platforms()
 
-  def make_map(self):
-    map_data = [[None for x in range(self.map_sz)] for y in range(self.map_sz)]
+  def match_red_platforms(self):
+    """Flips the current room's red platforms if they're out of step with
+    redplatforms_solid."""
+    if self.room.redplatforms_solid == self.redplatforms_solid:
+      return
+    self.room.redplatforms_solid = self.redplatforms_solid
 
-    for x in range(self.map_sz):
-      for y in range(self.map_sz):
-        rgb_val = self.map_data.get_at((x, y))
+    platforms = (self.grid & REDPLATFORM) != 0
+    self.grid[platforms] ^= WALL
 
-        map_data[x][y] = Tile((x * self.img_sz, y * self.img_sz), rgb_val, self.img_sz)
+    for x, y in zip(*N.nonzero(platforms)):
+      self.invalidate((x, y))
 
-    return map_data
+# Daemon threads still running at shutdown blow up noisily in 2.x.
+atexit.register(Map.stop_prefetching)
 
 class HPBar(Entity):
   BORDER_WIDTH   = 2
@@ -638,6 +1508,12 @@ class HPBar(Entity):
     pygame.draw.rect(screen, self.HURT_COLOR, self.hurt_rect.move(self.offset))
     pygame.draw.rect(screen, self.color, self.health_rect.move(self.offset))
 
+  def bounds(self):
+    return self.border_rect.move(self.offset)
+
+  def appearance(self):
+    return (self.health_rect.width, self.hurt_rect.width, tuple(self.color))
+
   def depth(self):
     return 100
 
@@ -657,7 +1533,106 @@ class Graphics:
   def colorize(surf, rgb):
     """Given a surf SURF and rgb array RGB=[R,G,B] representing whether (for
     instance) the R channel should be shown or not, returns a new surface with
-    only the desired color channels visible. R,G,B should only be 0 or 1."""
+    only the desired color channels visible. R,G,B should only be 0 or 1.
+
+    Does the whole surface at once with surfarray, so it is just as happy
+    being handed an entire sheet as a single tile. The output matches
+    colorize_slow pixel for pixel: grayscale is the integer mean of R, G and
+    B, masked by RGB, and (like the palette surface it replaces) the result
+    carries no colorkey."""
+
+    if DEBUG or min(rgb) == 1:
+      return surf
+
+    colored = pygame.surfarray.make_surface(Graphics.colorize_pixels(pygame.surfarray.array3d(surf), rgb))
+    return colored.convert()
+
+  @staticmethod
+  def colorize_pixels(pixels, rgb):
+    """colorize, for PIXELS (a surfarray.array3d) rather than a surface.
+    Never goes near the display, so what comes out doesn't depend on its
+    format; the asset cache (see assets.py) is built with this."""
+    if DEBUG or min(rgb) == 1:
+      return pixels
+
+    gray = (pixels.astype(N.uint16).sum(axis=2) / 3).astype(N.uint8)
+    return gray[:, :, N.newaxis] * N.array(rgb, dtype=N.uint8)
+
+  # How long desaturate may take on a whole SIZE frame (32 bit); see
+  # bench_post_process.py, which checks it.
+  POST_PROCESS_BUDGET = 0.003
+
+  # Reused between frames so desaturate doesn't allocate: (width, height) ->
+  # pair of uint32 arrays.
+  scratch_buffers = {}
+
+  @staticmethod
+  def desaturate(surface, rgb, rect=None):
+    """colorize, except done to SURFACE (the screen, usually) in place: every
+    pixel in RECT (all of SURFACE by default) becomes its grayscale, masked
+    to the channels RGB leaves on. Works straight on the surface's pixels,
+    so the frame never gets copied."""
+    if DEBUG or min(rgb) == 1:
+      return
+
+    rect = surface.get_rect() if rect is None else rect.clip(surface.get_rect())
+    if rect.width == 0 or rect.height == 0:
+      return
+    area = (slice(rect.left, rect.right), slice(rect.top, rect.bottom))
+
+    if surface.get_bytesize() == 4:
+      Graphics.desaturate_packed(surface, rgb, rect, area)
+    elif surface.get_bytesize() == 3:
+      pixels = pygame.surfarray.pixels3d(surface)[area]
+      gray = pixels.sum(axis=2, dtype=N.uint16) / 3
+      for channel, on in enumerate(rgb):
+        pixels[:, :, channel] = gray if on else 0
+      del pixels
+    else:
+      # Palette displays (SDL's dummy driver, for one) have to make do with a
+      # copy, mapped back to palette entries by hand.
+      pixels = pygame.surfarray.array3d(surface)[area]
+      gray = (pixels.sum(axis=2, dtype=N.uint16) / 3).astype(N.uint8)
+      colored = gray[:, :, N.newaxis] * N.array(rgb, dtype=N.uint8)
+
+      indices = pygame.surfarray.pixels2d(surface)
+      indices[area] = pygame.surfarray.map_array(surface, colored)
+      del indices
+
+  @staticmethod
+  def desaturate_packed(surface, rgb, rect, area):
+    """desaturate for 32 bit surfaces: whole pixels at a time, as uint32s,
+    which is a lot quicker than going channel by channel."""
+    size = surface.get_size()
+    if size not in Graphics.scratch_buffers:
+      Graphics.scratch_buffers[size] = (N.empty(size, dtype=N.uint32), N.empty(size, dtype=N.uint32))
+    gray, channel = [buf[:rect.width, :rect.height] for buf in Graphics.scratch_buffers[size]]
+
+    shifts = surface.get_shifts()[:3]
+    pixels = pygame.surfarray.pixels2d(surface)[area]
+
+    gray.fill(0)
+    for shift in shifts:
+      N.right_shift(pixels, shift, out=channel)
+      channel &= 0xFF
+      gray += channel
+
+    # x * 683 >> 11 is x / 3 for every x up to 3 * 255, only cheaper.
+    gray *= 683
+    gray >>= 11
+
+    # Gray in every channel that's on and nothing anywhere else, in one go:
+    # the channels don't overlap, so nothing carries.
+    spread = sum(1 << shift for shift, on in zip(shifts, rgb) if on)
+    N.multiply(gray, spread, out=pixels)
+
+    # Unlocks the surface.
+    del pixels
+
+  @staticmethod
+  def colorize_slow(surf, rgb):
+    """The original per-pixel colorize. Kept around as the reference that
+    colorize is checked against (see bench_colorize.py)."""
 
     #GOD this method is slow.
     if DEBUG or min(rgb) == 1:
@@ -679,6 +1654,7 @@ class FontManager:
   Again, this isn't a class so much as namespaced functions."""
 
   fonts = {}
+  atlases = {}
 
   @staticmethod
   def get(font_name):
@@ -687,6 +1663,15 @@ class FontManager:
 
     return FontManager.fonts[font_name]
 
+  @staticmethod
+  def get_atlas(font_name, color):
+    """A GlyphAtlas of FONT_NAME in COLOR, shared by everyone who asks."""
+    key = (font_name, tuple(color))
+    if key not in FontManager.atlases:
+      FontManager.atlases[key] = GlyphAtlas(FontManager.get(font_name), color)
+
+    return FontManager.atlases[key]
+
 class ActionText(Entity):
   def __init__(self, follow, x, y):
     self.text = StaticText("Press X to Die.", x, y)
@@ -701,6 +1686,12 @@ class ActionText(Entity):
   def render(self, screen):
     self.text.render(screen)
 
+  def bounds(self):
+    return self.text.bounds()
+
+  def appearance(self):
+    return self.text.appearance()
+
 class StaticText(Entity):
   """This is text that just stays in one place forever."""
 
@@ -712,6 +1703,7 @@ class StaticText(Entity):
     self.contents = contents
     self.font = FontManager.get("nokiafc22.ttf")
     self.fontcolor = (254, 255, 255)
+    self.justification = 1
 
   def set_text(self, new_text):
     self.contents = new_text
@@ -723,12 +1715,94 @@ class StaticText(Entity):
     fontrect = pygame.Rect((self.x, self.y, self.width, self.height))
 
     try:
-      rendered_text = render_textrect(self.contents, self.font, fontrect, self.fontcolor, (255,255,255), justification=1)
+      rendered_text = cached_render_textrect(self.contents, self.font, fontrect, self.fontcolor, (255,255,255), justification=self.justification)
     except TextRectException:
       print "Failed to render textbox."
     else:
       screen.blit(rendered_text, fontrect.topleft)
 
+  def bounds(self):
+    return pygame.Rect((self.x, self.y, self.width, self.height))
+
+  def appearance(self):
+    return self.contents
+
+class PerfOverlay(Entity):
+  """Shows what FrameProfiler has been seeing: average time per phase and
+  per kind of entity, and the worst recent frame. F3 shows or hides it."""
+
+  overlay = True
+
+  # Re-render the text this often (in frames); it's plenty, and doesn't churn
+  # the text cache.
+  REFRESH = 12
+
+  # A frame that takes longer than this is too slow for 24 fps.
+  BUDGET = 1.0 / 24
+
+  PHASES = ["events", "update", "render", "flip", "wait"]
+
+  def __init__(self, profiler, x=0, y=MAP_IN_PX):
+    Entity.__init__(self, x, y, SIZE[0])
+
+    self.profiler = profiler
+    self.visible = True
+    self.frames = 0
+
+    self.text = StaticText("", x, y)
+    self.text.width = SIZE[0] - x
+    self.text.height = SIZE[1] - y
+    self.text.justification = 0
+
+  def describe(self):
+    ms = lambda seconds: "%.1f" % (seconds * 1000)
+    profiler = self.profiler
+
+    lines = []
+
+    worst = profiler.worst_frame()
+    if worst is not None:
+      slowest = max(worst["phases"], key=worst["phases"].get)
+      marker = " !!" if worst["total"] > self.BUDGET else ""
+      lines.append("frame %sms, worst %sms (%s)%s" % (ms(profiler.average_frame()), ms(worst["total"]), slowest, marker))
+
+    phases = profiler.averages()
+    lines.append("  ".join("%s %s" % (phase, ms(phases[phase])) for phase in self.PHASES if phase in phases))
+
+    # The entity kinds that cost the most, update and render together.
+    kinds = {}
+    for (phase, kind), seconds in profiler.averages("entities").items():
+      kinds[kind] = kinds.get(kind, 0.0) + seconds
+    slowest_kinds = sorted(kinds, key=kinds.get, reverse=True)[:6]
+
+    for i in range(0, len(slowest_kinds), 3):
+      lines.append("  ".join("%s %s" % (kind, ms(kinds[kind])) for kind in slowest_kinds[i:i + 3]))
+
+    return "\n".join(lines)
+
+  def update(self, entities):
+    if KeysReleased.was_up(pygame.K_F3):
+      self.visible = not self.visible
+
+    if self.visible and self.frames % self.REFRESH == 0:
+      self.text.set_text(self.describe())
+    self.frames += 1
+
+  def render(self, screen):
+    if self.visible:
+      self.text.render(screen)
+
+  def bounds(self):
+    if self.visible:
+      return self.text.bounds()
+    return []
+
+  def appearance(self):
+    return self.text.appearance()
+
+  def depth(self):
+    return 200
+
 class TextChain(Entity):
   """In-game dialog. The current concept is that all dialog will 'follow'
   something, be it a character, NPC, enemy, etc (so long as it is an Entity).
@@ -737,6 +1811,8 @@ class TextChain(Entity):
   the game from progressing. You should still be able to move around while
   dialog is being shown. """
 
+  overlay = True
+
   def __init__(self, contents, follow, fontcolor=(255, 254, 255)):
     Entity.__init__(self, follow.x, follow.y, 200)
 
@@ -753,6 +1829,13 @@ class TextChain(Entity):
 
     self.speed = 2
 
+    # The whole message is laid out once, up front. Every frame we then only
+    # blit the glyphs that were revealed since the last one.
+    self.atlas = FontManager.get_atlas("nokiafc22.ttf", fontcolor)
+    self.text_surface = None
+    self.message_glyphs = []
+    self.glyphs_shown = 0
+
   def update(self, entities):
     # letter by letter, skip to end if player hits x
 
@@ -772,17 +1855,50 @@ class TextChain(Entity):
           entities.add(TextChain(self.rest_contents, self.follow, self.fontcolor))
 
   def depth(self):
-    return 0
+    # With the post-process, dialog goes on top of the desaturated frame
+    # along with the HUD. Otherwise it sits in the world, under fireballs.
+    return OVERLAY_DEPTH if g_post_process else 0
 
-  def render(self, screen):
-    fontrect = pygame.Rect((self.follow.x - self.width / 2, self.follow.y - self.follow.size - self.height, self.width, self.height))
+  def bounds(self):
+    # Go where whatever we follow is drawn this frame, which is between two
+    # simulation steps (see Image), or the dialog lags behind it in steps.
+    sprite = getattr(self.follow, 'sprite', None)
+    x, y = sprite.screen_rect().topleft if sprite is not None else (self.follow.x, self.follow.y)
+
+    return pygame.Rect((x - self.width / 2, y - self.follow.size - self.height, self.width, self.height))
+
+  def appearance(self):
+    return self.cur_contents
+
+  def lay_out(self):
+    self.text_surface = pygame.Surface((self.width, self.height))
+    self.text_surface.fill(self.atlas.key)
+    self.text_surface.set_colorkey(self.atlas.key)
 
     try:
-      rendered_text = render_textrect(self.cur_contents + " (press x)", self.font, fontrect, self.fontcolor, (255,255,255), justification=1)
+      placed = self.atlas.layout(self.end_contents + " (press x)", self.text_surface.get_rect(), justification=1)
     except TextRectException:
       print "Failed to render textbox."
-    else:
-      screen.blit(rendered_text, fontrect.topleft)
+      return
+
+    # Wrapping moves whitespace around but never reorders anything else, so
+    # the message's visible glyphs are simply the first ones laid out.
+    placed = [(c, position) for c, position in placed if not c.isspace()]
+    message_length = len([c for c in self.end_contents if not c.isspace()])
+
+    self.message_glyphs = placed[:message_length]
+    self.atlas.draw(self.text_surface, placed[message_length:])
+
+  def render(self, screen):
+    if self.text_surface is None:
+      self.lay_out()
+
+    shown = len(self.cur_contents) - len([c for c in self.cur_contents if c.isspace()])
+    if shown > self.glyphs_shown:
+      self.atlas.draw(self.text_surface, self.message_glyphs[self.glyphs_shown:shown])
+      self.glyphs_shown = shown
+
+    screen.blit(self.text_surface, self.bounds().topleft)
 
 class KeysReleased:
   """KeysReleased.was_up(pygame.K_somekey) will be true if and only if the
@@ -812,47 +1928,440 @@ class KeysReleased:
   def flush():
     keys = {}
 
-class Game:
+class KeyState:
+  """Looks like what pygame.key.get_pressed() returns, for the keys in
+  PRESSED."""
+
+  def __init__(self, pressed):
+    self.pressed = frozenset(pressed)
+
+  def __getitem__(self, key):
+    return 1 if key in self.pressed else 0
+
+class LiveInput:
+  """Input straight from the keyboard. Keys let go of between ticks count as
+  released on the next tick."""
+
   def __init__(self):
+    self.pending = []
+    self.released = []
+
+  def key_up(self, key):
+    self.pending.append(key)
+
+  def begin_tick(self):
+    self.released, self.pending = self.pending, []
+    for key in self.released:
+      KeysReleased.key_up(key)
+
+  def end_tick(self, game):
+    pass
+
+  def get_pressed(self):
+    return pygame.key.get_pressed()
+
+class ScriptedInput:
+  """Input from a script instead of the keyboard. SCRIPT is a list with one
+  (keys held, keys released) pair per tick; once it runs out we start over
+  from the top if LOOP, otherwise nothing is pressed anymore. The real
+  keyboard is ignored."""
+
+  def __init__(self, script, loop=False):
+    self.script = script
+    self.loop = loop
+    self.tick = -1
+    self.pressed = KeyState([])
+    self.released = []
+
+  def key_up(self, key):
+    pass
+
+  def begin_tick(self):
+    self.tick += 1
+
+    if self.loop and self.script:
+      held, released = self.script[self.tick % len(self.script)]
+    elif self.tick < len(self.script):
+      held, released = self.script[self.tick]
+    else:
+      held, released = [], []
+
+    self.pressed = KeyState(held)
+    self.released = released
+    for key in released:
+      KeysReleased.key_up(key)
+
+  def end_tick(self, game):
+    pass
+
+  def get_pressed(self):
+    return self.pressed
+
+def held_keys(pressed):
+  """The keys held down in PRESSED (what some get_pressed() returned)."""
+  if isinstance(pressed, KeyState):
+    return sorted(pressed.pressed)
+  return [key for key, down in enumerate(pressed) if down]
+
+class RecordingInput:
+  """Passes SOURCE's input on, writing it to an input log at PATH as it goes
+  along with Game.checksum() after every tick (see replay.py)."""
+
+  def __init__(self, source, path):
+    self.source = source
+    self.pressed = KeyState([])
+    self.released = []
+
+    seed = random.randint(0, 0xffffffff)
+    random.seed(seed)
+
+    self.log = replay.InputLogWriter(path, TICKS_PER_SECOND, seed)
+    atexit.register(self.log.close)
+
+  def key_up(self, key):
+    self.source.key_up(key)
+
+  def begin_tick(self):
+    self.source.begin_tick()
+
+    # Take what's held once, so what we write down is exactly what the game
+    # saw.
+    self.pressed = KeyState(held_keys(self.source.get_pressed()))
+    self.released = list(self.source.released)
+
+  def end_tick(self, game):
+    self.source.end_tick(game)
+    self.log.write(sorted(self.pressed.pressed), self.released, game.checksum())
+
+  def get_pressed(self):
+    return self.pressed
+
+class ReplayDivergedException(Exception):
+  pass
+
+class ReplayInput(ScriptedInput):
+  """Plays back the input log at PATH (see RecordingInput), checking after
+  every tick that the game is where it was when the log was recorded. If it
+  isn't, raises ReplayDivergedException."""
+
+  def __init__(self, path):
+    self.log = replay.InputLog(path)
+    ScriptedInput.__init__(self, self.log.script())
+
+    if self.log.ticks_per_second != TICKS_PER_SECOND:
+      print "Warning: %s was recorded at %d ticks/s, we run at %d." % (path, self.log.ticks_per_second, TICKS_PER_SECOND)
+
+    random.seed(self.log.seed)
+
+  def end_tick(self, game):
+    if self.tick >= len(self.log):
+      return
+
+    recorded = self.log.ticks[self.tick][2]
+    checksum = game.checksum()
+    if checksum != recorded:
+      raise ReplayDivergedException("tick %d: state checksum %08x, recorded %08x" % (self.tick, checksum, recorded))
+
+class Input:
+  """Where the game gets its input from: the keyboard normally, but anything
+  with key_up/begin_tick/end_tick/get_pressed and a list of keys released
+  this tick (like a ScriptedInput) can stand in for it. Again, namespaced
+  functions more than a class."""
+
+  source = LiveInput()
+
+  @staticmethod
+  def get_pressed():
+    return Input.source.get_pressed()
+
+def flatten_rects(rects):
+  """Entity.bounds() can give back None, a Rect or a (nested) list of them."""
+  if rects is None:
+    return []
+  if isinstance(rects, pygame.Rect):
+    return [rects]
+  return [rect for r in rects for rect in flatten_rects(r)]
+
+class DirtyRectRenderer:
+  """Only redraws (and pushes to the display) the parts of the screen that
+  changed since last frame, instead of the whole thing.
+
+  Whatever Entity.bounds() returns None for (the map and its tiles) counts as
+  background: the map's baked layer is what gets put back wherever something
+  moved away, and the map tells us which parts of the layer it redrew. Every
+  other entity reports where it draws through bounds(), and what it looks
+  like through appearance(); if either changed since last frame, both the
+  old and new bounds are dirty. Each dirty rect is then redrawn, clipped,
+  from the background up."""
+
+  def __init__(self, screen, map, post_process=False):
+    self.screen = screen
+    self.map = map
+    self.map.track_changes = True
+    self.post_process = post_process
+    self.saturation = None
+    self.previous = {}
+    self.first_frame = True
+    self.pixels_pushed = 0
+
+  def merge(self, rects):
+    screen_rect = self.screen.get_rect()
+    rects = [rect.clip(screen_rect) for rect in rects]
+    rects = [rect for rect in rects if rect.width > 0 and rect.height > 0]
+
+    merged = []
+    while rects:
+      rect = rects.pop()
+      overlapping = rect.collidelistall(rects)
+      if overlapping:
+        rect = rect.unionall([rects[i] for i in overlapping])
+        rects = [r for i, r in enumerate(rects) if i not in overlapping]
+        rects.append(rect)
+      else:
+        merged.append(rect)
+    return merged
+
+  def render(self, entities):
+    self.map.bake()
+
+    dirty = self.map.take_changed_rects()
+    current = {}
+    drawn = []
+
+    for entity in entities.in_render_order():
+      rects = flatten_rects(entity.bounds())
+      if not rects:
+        continue
+
+      looks = (rects, entity.appearance())
+      current[entity] = looks
+      drawn.append((entity, rects))
+
+      if self.previous.get(entity) != looks:
+        dirty += rects + self.previous.get(entity, ([], None))[0]
+
+    for entity in self.previous:
+      if entity not in current:
+        dirty += self.previous[entity][0]
+
+    self.previous = current
+
+    # With the post-process, the whole frame changes color along with
+    # g_saturation.
+    if self.post_process and self.saturation != g_saturation:
+      self.saturation = g_saturation[:]
+      dirty = [self.screen.get_rect()]
+
+    if self.first_frame:
+      dirty = [self.screen.get_rect()]
+      self.first_frame = False
+
+    dirty = self.merge(dirty)
+
+    for rect in dirty:
+      self.screen.set_clip(rect)
+      self.screen.fill((0, 0, 0))
+      self.map.render(self.screen)
+
+      for entity, rects in drawn:
+        if self.post_process and entities.entity_depths[entity] >= OVERLAY_DEPTH:
+          break
+        if rect.collidelist(rects) != -1:
+          entity.render(self.screen)
+
+      if self.post_process:
+        Graphics.desaturate(self.screen, g_saturation, rect)
+
+        for entity, rects in drawn:
+          if entities.entity_depths[entity] >= OVERLAY_DEPTH and rect.collidelist(rects) != -1:
+            entity.render(self.screen)
+
+    self.screen.set_clip(None)
+
+    self.pixels_pushed = sum(rect.width * rect.height for rect in dirty)
+    return dirty
+
+class Game:
+  """DEPTH is the display's bits per pixel; 0 takes whatever it gives us."""
+
+  def __init__(self, dirty_rects=False, profile=False, post_process=False, map_file="map.png", depth=0):
     pygame.font.init()
 
-    self.screen = pygame.display.set_mode(SIZE)
+    global g_post_process
+    g_post_process = post_process
+
+    self.screen = pygame.display.set_mode(SIZE, 0, depth)
+
+    if not DEBUG:
+      SheetRegistry.use_assets(assets.load(Graphics.colorize_pixels))
 
     self.entities = EntityManager()
 
     character = Character(21, 20, TILE_SIZE)
     self.entities.add(character)
-    self.map = Map(TILE_SIZE, MAP_SIZE, "map.png")
+    self.map = Map(TILE_SIZE, MAP_SIZE, map_file)
     self.map.new_map(self.entities, 0, 0, rel=False)
 
     self.entities.add(self.map)
+    self.entities.add(Fireballs(self.map))
     self.entities.add(HeadsUpDisplay(character))
 
-    self.entities.add(TextChain(["Wazzup? This text is long like longcat.", "This one isn't", "This dialog is amazing isnt it."], self.entities.get_one(lambda e: isinstance(e, Character))))
+    self.entities.add(TextChain(["Wazzup? This text is long like longcat.", "This one isn't", "This dialog is amazing isnt it."], self.entities.get_one_of(Character)))
 
     self.clock = pygame.time.Clock()
+
+    # Pixels sent to the display last frame.
+    self.pixels_pushed = 0
+    self.dirty_renderer = DirtyRectRenderer(self.screen, self.map, post_process) if dirty_rects else None
+    self.dirty = None
+
+    self.profiler = None
+    if profile:
+      self.profiler = self.entities.profiler = FrameProfiler()
+      self.entities.add(PerfOverlay(self.profiler))
+
     print "Done loading."
+    print "Sheets: %(reads)d files read, %(decodes)d decoded, %(colorizes)d colorized" % SheetRegistry.stats()
+
+    if DEBUG:
+      print "Tile cache:", get_tilesheet_image.cache.stats()
 
   def main_loop(self):
+    """Simulates at a fixed TICKS_PER_SECOND no matter how fast we render,
+    and renders as often as MAX_FPS allows, with images interpolated
+    between simulation steps. If we fall behind we catch up, but by no more
+    than MAX_CATCHUP_STEPS a frame; past that the game slows down instead of
+    spending ever longer catching up."""
+    step_length = 1.0 / TICKS_PER_SECOND
+    accumulator = 0.0
+    previous = default_timer()
+
     while True:
+      profiler = self.profiler
+      if profiler:
+        profiler.begin_frame()
+
       for event in pygame.event.get():
         if event.type == pygame.QUIT:
           exit(0)
         if event.type == pygame.KEYUP:
-          KeysReleased.key_up(event.key)
+          Input.source.key_up(event.key)
+
+      if profiler:
+        profiler.mark("events")
+
+      now = default_timer()
+      accumulator += now - previous
+      previous = now
+
+      steps = 0
+      while accumulator >= step_length and steps < MAX_CATCHUP_STEPS:
+        self.step()
+        accumulator -= step_length
+        steps += 1
+
+      if accumulator >= step_length:
+        accumulator = 0.0
+
+      Image.alpha = accumulator / step_length
+
+      if profiler:
+        profiler.mark("update")
+
+      self.draw()
 
-      self.entities.update()
+      self.clock.tick(MAX_FPS)
+
+      if profiler:
+        profiler.end_frame("wait")
+
+  def step(self):
+    """One simulation step."""
+    Image.step += 1
+    Input.source.begin_tick()
+
+    self.entities.update()
+
+    Input.source.end_tick(self)
+    KeysReleased.flush()
+
+  def checksum(self):
+    """A CRC of the simulation state: where every entity in the world is and
+    how it's moving, the character's health, the room we're in and the
+    saturation. Overlays (see Entity.overlay) don't count. Two runs fed the
+    same input should agree on it after every tick (see ReplayInput)."""
+    character = self.entities.get_one_of(Character)
+    fireballs = self.entities.get_one_of(Fireballs)
+
+    state = [Image.step, g_saturation, self.map.mapx, self.map.mapy,
+             character.health, character.on_ground, character.direction]
+    state += sorted((entity_kind(entity), entity.x, entity.y, list(getattr(entity, 'v', [])))
+                    for entity in self.entities.in_render_order()
+                    if not entity.overlay and getattr(entity, 'x', None) is not None)
+
+    crc = zlib.crc32(repr(state))
+    for column in (fireballs.xs, fireballs.ys, fireballs.dxs, fireballs.dys):
+      crc = zlib.crc32(column[fireballs.alive].tostring(), crc)
+
+    return crc & 0xffffffff
+
+  def tick(self):
+    """One step and one frame, lock-step and with no interpolation. This is
+    how the headless runner drives the game."""
+    profiler = self.profiler
+    if profiler:
+      profiler.mark("events")
+
+    self.step()
+    if profiler:
+      profiler.mark("update")
+
+    Image.alpha = 1.0
+    self.draw()
+
+  def draw(self):
+    profiler = self.profiler
+
+    self.render()
+    if profiler:
+      profiler.mark("render")
+
+    self.present()
+    if profiler:
+      profiler.mark("flip")
+
+  def render(self):
+    if self.dirty_renderer is None:
       self.screen.fill((0,0,0))
-      self.entities.render(self.screen)
 
+      if g_post_process:
+        self.entities.render(self.screen, high=OVERLAY_DEPTH)
+        Graphics.desaturate(self.screen, g_saturation)
+        self.entities.render(self.screen, low=OVERLAY_DEPTH)
+      else:
+        self.entities.render(self.screen)
+    else:
+      self.dirty = self.dirty_renderer.render(self.entities)
+
+  def present(self):
+    if self.dirty_renderer is None:
       pygame.display.flip()
-      self.clock.tick(24)
+      self.pixels_pushed = SIZE[0] * SIZE[1]
+    else:
+      pygame.display.update(self.dirty)
+      self.pixels_pushed = self.dirty_renderer.pixels_pushed
 
-      KeysReleased.flush()
+      pygame.display.set_caption("%d px pushed" % self.pixels_pushed)
 
 def main():
   game = Game()
 
 if __name__ == "__main__":
-  game = Game()
+  if "--record" in sys.argv:
+    Input.source = RecordingInput(Input.source, sys.argv[sys.argv.index("--record") + 1])
+
+  map_file = sys.argv[sys.argv.index("--map") + 1] if "--map" in sys.argv else "map.png"
+
+  game = Game(dirty_rects="--dirty" in sys.argv, profile="--profile" in sys.argv,
+              post_process="--post" in sys.argv, map_file=map_file)
   game.main_loop()
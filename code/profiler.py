@@ -0,0 +1,68 @@
+from collections import deque
+from timeit import default_timer
+
+class FrameProfiler(object):
+  """Times where each frame goes, phase by phase (see Game.main_loop), and
+  how long each kind of entity spends in update and render. Keeps the last
+  WINDOW frames around for rolling averages and the worst frame.
+
+  Phases are timed with marks: mark(phase) charges everything since the
+  previous mark (or begin_frame) to PHASE."""
+
+  def __init__(self, window=48):
+    self.frames = deque(maxlen=window)
+    self.frame = None
+    self.last_mark = None
+
+  def begin_frame(self):
+    self.frame = {"phases": {}, "entities": {}}
+    self.last_mark = default_timer()
+
+  def mark(self, phase):
+    if self.frame is None:
+      return
+
+    now = default_timer()
+    phases = self.frame["phases"]
+    phases[phase] = phases.get(phase, 0.0) + now - self.last_mark
+    self.last_mark = now
+
+  def add_entity(self, phase, kind, seconds):
+    if self.frame is None:
+      return
+
+    key = (phase, kind)
+    entities = self.frame["entities"]
+    entities[key] = entities.get(key, 0.0) + seconds
+
+  def end_frame(self, phase):
+    """Charges the rest of the frame to PHASE and files the frame away."""
+    if self.frame is None:
+      return
+
+    self.mark(phase)
+    self.frame["total"] = sum(self.frame["phases"].values())
+    self.frames.append(self.frame)
+    self.frame = None
+
+  def averages(self, key="phases"):
+    """Average seconds per frame for each phase (or, with key="entities",
+    each (phase, entity kind)) over the window."""
+    totals = {}
+    for frame in self.frames:
+      for name, seconds in frame[key].items():
+        totals[name] = totals.get(name, 0.0) + seconds
+
+    count = float(len(self.frames) or 1)
+    return dict((name, seconds / count) for name, seconds in totals.items())
+
+  def average_frame(self):
+    if not self.frames:
+      return 0.0
+    return sum(frame["total"] for frame in self.frames) / len(self.frames)
+
+  def worst_frame(self):
+    """The slowest frame in the window, or None."""
+    if not self.frames:
+      return None
+    return max(self.frames, key=lambda frame: frame["total"])
@@ -1,11 +1,143 @@
 """Source taken from http://www.pygame.org/pcr/text_rect/index.php"""
 
+from lrucache import LRUCache
+
+# How many distinct rendered text surfaces cached_render_textrect keeps.
+TEXT_CACHE_SIZE = 64
+
+text_cache = LRUCache(TEXT_CACHE_SIZE)
+
 class TextRectException:
     def __init__(self, message = None):
         self.message = message
     def __str__(self):
         return self.message
 
+class GlyphWidths(object):
+    """Per-font table of glyph advances, so that a string can be measured by
+    adding up numbers instead of asking SDL_ttf about the whole thing again.
+
+    A string's real width can differ from the sum of its advances by how far
+    its first and last glyphs stick out of their boxes; we keep track of the
+    worst of that as slack, and only ask the font when a measurement is
+    closer to a limit than the slack (never, for the fonts we ship). Kerning
+    is assumed away, our fonts don't have any."""
+
+    def __init__(self, font):
+        self.font = font
+        self.advances = {}
+        self.left_slack = 0
+        self.right_slack = 0
+
+    def advance(self, char):
+        if char not in self.advances:
+            metrics = self.font.metrics(char)[0]
+            if metrics is None:
+                # No glyph; let SDL_ttf figure out what it'll draw instead.
+                advance = self.font.size(char)[0]
+                self.right_slack = max(self.right_slack, advance)
+            else:
+                minx, maxx, miny, maxy, advance = metrics
+                self.left_slack = max(self.left_slack, -minx)
+                self.right_slack = max(self.right_slack, maxx - advance)
+            self.advances[char] = advance
+        return self.advances[char]
+
+    def width(self, text):
+        return sum([self.advance(char) for char in text])
+
+    def exact_near(self, text, width, limit):
+        """WIDTH (the width of TEXT, as measured by self.width) if it's
+        clearly on one side of LIMIT, otherwise what the font says. Either
+        way the answer compares to LIMIT the same as font.size(TEXT)[0].
+        TEXT may be a callable, so it's only built when needed."""
+        if limit - self.left_slack - self.right_slack <= width <= limit:
+            if callable(text):
+                text = text()
+            return self.font.size(text)[0]
+        return width
+
+glyph_widths = {}
+
+def widths_for(font):
+    if font not in glyph_widths:
+        glyph_widths[font] = GlyphWidths(font)
+    return glyph_widths[font]
+
+def wrap_lines(string, font, rect):
+    """Word-wraps STRING into the lines render_textrect would draw in RECT.
+    Raises a TextRectException if a single word is too wide to fit.
+
+    Each word is measured once from the font's glyph widths, so this is
+    linear in the length of STRING."""
+
+    widths = widths_for(font)
+    space = widths.advance(" ")
+
+    final_lines = []
+
+    requested_lines = string.splitlines()
+
+    # Create a series of lines that will fit on the provided
+    # rectangle.
+
+    for requested_line in requested_lines:
+        words = requested_line.split(' ')
+        word_widths = [widths.width(word) for word in words]
+        line_width = sum(word_widths) + space * (len(words) - 1)
+
+        if widths.exact_near(requested_line, line_width, rect.width) > rect.width:
+            # if any of our words are too long to fit, return.
+            for word, width in zip(words, word_widths):
+                if widths.exact_near(word, width, rect.width) >= rect.width:
+                    raise TextRectException, "The word " + word + " is too long to fit in the rect passed."
+            # Start a new line
+            accumulated_words = []
+            accumulated_width = 0
+            for word, width in zip(words, word_widths):
+                test_width = accumulated_width + width + space
+                test_line = lambda: "".join([w + " " for w in accumulated_words + [word]])
+                # Build the line while the words fit.
+                if widths.exact_near(test_line, test_width, rect.width) < rect.width:
+                    accumulated_words.append(word)
+                    accumulated_width = test_width
+                else:
+                    final_lines.append("".join([w + " " for w in accumulated_words]))
+                    accumulated_words = [word]
+                    accumulated_width = width + space
+            final_lines.append("".join([w + " " for w in accumulated_words]))
+        else:
+            final_lines.append(requested_line)
+
+    return final_lines
+
+def layout_textrect(string, font, rect, justification=0):
+    """Where render_textrect would put each line of STRING, without drawing
+    anything: a list of (line, (x, y)) relative to RECT's top left. Raises a
+    TextRectException in the same cases render_textrect does."""
+
+    layout = []
+
+    line_height = font.get_height()
+    accumulated_height = 0
+    for line in wrap_lines(string, font, rect):
+        if accumulated_height + line_height >= rect.height:
+            raise TextRectException, "Once word-wrapped, the text string was too tall to fit in the rect."
+        x = 0
+        if line != "":
+            if justification == 0:
+                x = 0
+            elif justification == 1:
+                x = (rect.width - font.size(line)[0]) / 2
+            elif justification == 2:
+                x = rect.width - font.size(line)[0]
+            else:
+                raise TextRectException, "Invalid justification argument: " + str(justification)
+        layout.append((line, (x, accumulated_height)))
+        accumulated_height += line_height
+
+    return layout
+
 def render_textrect(string, font, rect, text_color, background_color, justification=0):
     """Returns a surface containing the passed text string, reformatted
     to fit within the given rect, word-wrapping as necessary. The text
@@ -31,33 +163,7 @@ def render_textrect(string, font, rect, text_color, background_color, justificat
 
     import pygame
     
-    final_lines = []
-
-    requested_lines = string.splitlines()
-
-    # Create a series of lines that will fit on the provided
-    # rectangle.
-
-    for requested_line in requested_lines:
-        if font.size(requested_line)[0] > rect.width:
-            words = requested_line.split(' ')
-            # if any of our words are too long to fit, return.
-            for word in words:
-                if font.size(word)[0] >= rect.width:
-                    raise TextRectException, "The word " + word + " is too long to fit in the rect passed."
-            # Start a new line
-            accumulated_line = ""
-            for word in words:
-                test_line = accumulated_line + word + " "
-                # Build the line while the words fit.    
-                if font.size(test_line)[0] < rect.width:
-                    accumulated_line = test_line 
-                else: 
-                    final_lines.append(accumulated_line) 
-                    accumulated_line = word + " " 
-            final_lines.append(accumulated_line)
-        else: 
-            final_lines.append(requested_line) 
+    layout = layout_textrect(string, font, rect, justification)
 
     # Let's try to write the text out on the surface.
 
@@ -66,20 +172,22 @@ def render_textrect(string, font, rect, text_color, background_color, justificat
 
     surface.set_colorkey((255,255,255))
 
-    accumulated_height = 0 
-    for line in final_lines: 
-        if accumulated_height + font.size(line)[1] >= rect.height:
-            raise TextRectException, "Once word-wrapped, the text string was too tall to fit in the rect."
+    for line, position in layout:
         if line != "":
             tempsurface = font.render(line, False, text_color) # False -> Anti-Alias
-            if justification == 0:
-                surface.blit(tempsurface, (0, accumulated_height))
-            elif justification == 1:
-                surface.blit(tempsurface, ((rect.width - tempsurface.get_width()) / 2, accumulated_height))
-            elif justification == 2:
-                surface.blit(tempsurface, (rect.width - tempsurface.get_width(), accumulated_height))
-            else:
-                raise TextRectException, "Invalid justification argument: " + str(justification)
-        accumulated_height += font.size(line)[1]
+            surface.blit(tempsurface, position)
 
     return surface
+
+def cached_render_textrect(string, font, rect, text_color, background_color, justification=0):
+    """Same as render_textrect, but remembers the surfaces it hands out, so
+    text that doesn't change from frame to frame is only rendered once.
+
+    The returned surface is shared between callers: blit it, don't draw on it.
+    Failures aren't cached, the TextRectException is raised every time."""
+
+    key = (string, font, (rect.width, rect.height), tuple(text_color),
+           tuple(background_color), justification)
+
+    return text_cache.lookup(key, lambda: render_textrect(string, font, rect, text_color,
+                                                          background_color, justification))
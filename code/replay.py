@@ -0,0 +1,69 @@
+"""Input logs: every tick's held keys, released keys and a checksum of the
+simulation state after the tick, in a small binary file. Record a session
+once (python main.py --record session.log) and replay it as often as you
+like (python headless.py --replay session.log) to time the exact same game
+before and after a change, and to make sure the change didn't change what
+the game does.
+
+The file is HEADER, then one TICK per tick, each followed by its key codes
+(held ones first, then released ones) as unsigned shorts."""
+
+import struct
+
+MAGIC = "FATHOMI1"
+HEADER = struct.Struct("<8sHI")         # magic, ticks per second, random seed
+TICK = struct.Struct("<IBB")            # checksum, keys held, keys released
+KEY = struct.Struct("<H")
+
+class InputLogWriter(object):
+  def __init__(self, path, ticks_per_second, seed):
+    self.file = open(path, "wb")
+    self.file.write(HEADER.pack(MAGIC, ticks_per_second, seed))
+    self.ticks = 0
+
+  def write(self, held, released, checksum):
+    keys = list(held) + list(released)
+    self.file.write(TICK.pack(checksum, len(held), len(released)))
+    self.file.write(struct.pack("<%dH" % len(keys), *keys))
+    self.ticks += 1
+
+  def close(self):
+    if not self.file.closed:
+      self.file.close()
+
+class InputLog(object):
+  """A log read back in: TICKS is a list of (held, released, checksum), one
+  per tick."""
+
+  def __init__(self, path):
+    with open(path, "rb") as f:
+      data = f.read()
+
+    if len(data) < HEADER.size:
+      raise ValueError("%s is too short to be an input log" % path)
+
+    magic, self.ticks_per_second, self.seed = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+      raise ValueError("%s isn't an input log" % path)
+
+    self.ticks = []
+    offset = HEADER.size
+
+    # A recording cut short (the game crashed, say) can end halfway through
+    # a tick; we keep every tick before that.
+    while offset + TICK.size <= len(data):
+      checksum, held, released = TICK.unpack_from(data, offset)
+      end = offset + TICK.size + (held + released) * KEY.size
+      if end > len(data):
+        break
+
+      keys = struct.unpack_from("<%dH" % (held + released), data, offset + TICK.size)
+      self.ticks.append((list(keys[:held]), list(keys[held:]), checksum))
+      offset = end
+
+  def __len__(self):
+    return len(self.ticks)
+
+  def script(self):
+    """The log as a main.ScriptedInput script."""
+    return [(held, released) for held, released, checksum in self.ticks]
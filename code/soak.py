@@ -0,0 +1,249 @@
+"""Soak tests: lots of headless games at once, one per CPU, each starting in
+some room of the map at a random open spot and fed random (or scripted)
+input for a while. Every run's tick times and whatever it crashed with go
+into one report, so a change can be checked against every room of the map
+in a few minutes.
+
+Usage: python soak.py [--runs N] [--ticks N] [--map FILE] [--scripts NAMES]
+                      [--seed N] [--processes N] [--timeout SECONDS]
+                      [--report FILE] [--dirty]
+
+Exits with 1 if any run crashed or never came back."""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import time
+import traceback
+
+# Has to happen before pygame sets up the display.
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+
+import pygame
+import main
+import assets
+import headless
+
+# Keys a random script holds down, and the ones it lets go of now and then
+# (the color toggles, and x for dialog).
+HELD_KEYS = [pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN, pygame.K_z, pygame.K_x]
+RELEASED_KEYS = [pygame.K_a, pygame.K_s, pygame.K_d, pygame.K_x]
+
+def random_script(rng, ticks):
+  """TICKS ticks of mashing keys: random keys held for random stretches,
+  with a random key released at the start of some stretches."""
+  script = []
+  while len(script) < ticks:
+    held = rng.sample(HELD_KEYS, rng.randint(0, 3))
+    released = [rng.choice(RELEASED_KEYS)] if rng.random() < 0.3 else []
+    length = rng.randint(1, 40)
+    script += [(held, released)] + [(held, [])] * (length - 1)
+  return script[:ticks]
+
+def script_for(name, rng, ticks):
+  if name == "random":
+    return random_script(rng, ticks)
+  return headless.SCRIPTS[name]()
+
+SCRIPTS = ["random"] + sorted(headless.SCRIPTS.keys())
+
+def make_jobs(map_file, runs, ticks, scripts, seed):
+  """RUNS runs per room, each with a seed of its own, a random open spawn
+  point and one of SCRIPTS (taking turns)."""
+  map = main.Map(main.TILE_SIZE, main.MAP_SIZE, map_file)
+  rooms_across, rooms_down = map.rooms()
+
+  jobs = []
+  for mapy in range(rooms_down):
+    for mapx in range(rooms_across):
+      cells = map.build_room(mapx, mapy).open_cells()
+
+      for _ in range(runs):
+        run_seed = seed + len(jobs)
+        rng = random.Random(run_seed)
+        jobs.append({ "run": len(jobs)
+                    , "seed": run_seed
+                    , "map": map_file
+                    , "room": [mapx, mapy]
+                    , "spawn": list(rng.choice(cells)) if cells else None
+                    , "script": scripts[len(jobs) % len(scripts)]
+                    , "ticks": ticks
+                    })
+  return jobs
+
+def reset():
+  """Puts back the globals a game leaves changed, so the next run in this
+  process starts out like it was the first."""
+  main.g_saturation = [main.COLORED, main.COLORED, main.COLORED]
+  main.Image.step = 0
+  main.Image.alpha = 1.0
+  main.KeysReleased.keys = {}
+
+def init_worker():
+  pygame.init()
+
+  # SDL turns these into quit events, which nobody here would ever look at.
+  # Ctrl-C is for the parent, and the pool stops workers with SIGTERM.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+  # Every game prints how its loading went.
+  sys.stdout = open(os.devnull, "w")
+
+def run_job(job, dirty_rects=False):
+  """Plays JOB and returns it with its results: the tick stats, and where
+  and how it crashed if it did."""
+  reset()
+  result = dict(job, status="ok")
+  runner = None
+
+  try:
+    rng = random.Random(job["seed"])
+    random.seed(job["seed"])
+
+    if job["spawn"] is None:
+      raise AssertionError("room %s has nowhere to stand" % job["room"])
+
+    source = main.ScriptedInput(script_for(job["script"], rng, job["ticks"]), loop=True)
+    runner = headless.HeadlessRunner(source, dirty_rects=dirty_rects, map_file=job["map"])
+    game = runner.game
+
+    game.map.new_map(game.entities, job["room"][0], job["room"][1], rel=False)
+    character = game.entities.get_one_of(main.Character)
+    character.x, character.y = job["spawn"][0] * main.TILE_SIZE, job["spawn"][1] * main.TILE_SIZE
+
+    result["stats"] = runner.run(job["ticks"])
+    result["final_room"] = [game.map.mapx, game.map.mapy]
+  except Exception, e:
+    result["status"] = "crash"
+    result["error"] = "%s: %s" % (type(e).__name__, e)
+    result["traceback"] = traceback.format_exc()
+    if runner is not None:
+      result["tick"] = len(runner.tick_times)
+      result["stats"] = runner.stats()
+
+  return result
+
+def run_job_star(args):
+  return run_job(*args)
+
+def soak(jobs, processes, timeout, dirty_rects=False):
+  """Runs every one of JOBS on a pool of PROCESSES processes. Jobs that
+  don't come back within TIMEOUT seconds of the previous one (a worker hung
+  or died) are reported as lost."""
+  pool = multiprocessing.Pool(processes, init_worker)
+  results = {}
+
+  try:
+    done = pool.imap_unordered(run_job_star, [(job, dirty_rects) for job in jobs])
+    for _ in jobs:
+      result = done.next(timeout)
+      results[result["run"]] = result
+      sys.stderr.write("\r%d/%d runs" % (len(results), len(jobs)))
+    pool.close()
+  except multiprocessing.TimeoutError:
+    pool.terminate()
+  except KeyboardInterrupt:
+    pool.terminate()
+    raise
+  finally:
+    sys.stderr.write("\n")
+    pool.join()
+
+  for job in jobs:
+    if job["run"] not in results:
+      results[job["run"]] = dict(job, status="lost", error="no result within %ds" % timeout)
+
+  return [results[job["run"]] for job in jobs]
+
+def summarize(results, seconds, processes):
+  ran = [result for result in results if "stats" in result and result["stats"]["ticks"]]
+  p50s = sorted(result["stats"]["p50_ms"] for result in ran)
+
+  crashes = {}
+  for result in results:
+    if result["status"] != "ok":
+      crashes.setdefault(result["error"], []).append(result["run"])
+
+  worst = max(ran, key=lambda result: result["stats"]["worst_ms"]) if ran else None
+
+  return { "runs": len(results)
+         , "rooms": len(set(tuple(result["room"]) for result in results))
+         , "seconds": seconds
+         , "processes": processes
+         , "ok": sum(1 for result in results if result["status"] == "ok")
+         , "crashed": sum(1 for result in results if result["status"] == "crash")
+         , "lost": sum(1 for result in results if result["status"] == "lost")
+         , "ticks": sum(result["stats"]["ticks"] for result in ran)
+         , "median_p50_ms": headless.percentile(p50s, 0.5)
+         , "worst_p99_ms": max([result["stats"]["p99_ms"] for result in ran] or [0.0])
+         , "worst_ms": worst["stats"]["worst_ms"] if worst else 0.0
+         , "worst_run": worst["run"] if worst else None
+         , "crashes": crashes
+         }
+
+def describe(run):
+  return "run %(run)d: room %(room)s, spawn %(spawn)s, seed %(seed)d, script %(script)s" % run
+
+def report(summary, results):
+  print "%(runs)d runs over %(rooms)d rooms in %(seconds).1fs on %(processes)d processes: " \
+        "%(ok)d ok, %(crashed)d crashed, %(lost)d lost" % summary
+  print "%(ticks)d ticks: median p50 %(median_p50_ms).2fms, worst p99 %(worst_p99_ms).2fms, " \
+        "worst %(worst_ms).2fms" % summary
+
+  if summary["worst_run"] is not None:
+    print "  slowest tick in %s" % describe(results[summary["worst_run"]])
+
+  for error, runs in sorted(summary["crashes"].items(), key=lambda item: -len(item[1])):
+    first = results[runs[0]]
+    print "%dx %s" % (len(runs), error)
+    print "  first in %s%s" % (describe(first), ", tick %d" % first["tick"] if "tick" in first else "")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Soak test every room of a map with lots of headless games.")
+  parser.add_argument("--runs", type=int, default=8, help="runs per room")
+  parser.add_argument("--ticks", type=int, default=1000, help="ticks per run")
+  parser.add_argument("--map", default="map.png", help="map image or world (see world.py) under data/maps")
+  parser.add_argument("--scripts", default=",".join(SCRIPTS),
+                      help="comma separated, out of %s; runs take turns" % ", ".join(SCRIPTS))
+  parser.add_argument("--seed", type=int, default=0, help="seed of the first run; the rest count up")
+  parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+  parser.add_argument("--timeout", type=int, default=300, help="seconds to wait for the next run to finish")
+  parser.add_argument("--report", default="soak-report.json", help="where to write every run's results")
+  parser.add_argument("--dirty", action="store_true", help="use dirty rectangle rendering")
+  args = parser.parse_args()
+
+  scripts = args.scripts.split(",")
+  for name in scripts:
+    if name not in SCRIPTS:
+      parser.error("no script called %s" % name)
+
+  # The workers get forked off this, so have the asset cache built before
+  # they'd all go and build it at once.
+  pygame.init()
+  pygame.display.set_mode(main.SIZE, 0, headless.DEPTH)
+  if not main.DEBUG:
+    assets.load(main.Graphics.colorize_pixels)
+
+  jobs = make_jobs(args.map, args.runs, args.ticks, scripts, args.seed)
+
+  # Nothing should be prefetching here, but make sure: a worker forked while
+  # that thread held a lock (SheetRegistry's, say) would wait on it forever.
+  main.Map.stop_prefetching()
+
+  start = time.time()
+  results = soak(jobs, args.processes, args.timeout, args.dirty)
+  summary = summarize(results, time.time() - start, args.processes)
+
+  with open(args.report, "w") as f:
+    json.dump({"summary": summary, "runs": results}, f, indent=1, sort_keys=True)
+
+  report(summary, results)
+  print "Report written to %s" % args.report
+
+  if summary["crashed"] or summary["lost"]:
+    sys.exit(1)
@@ -0,0 +1,123 @@
+"""Worlds: every room's tile kinds (see Tile.KINDS) in one binary file that
+the game maps into memory and reads room by room, so a world costs memory
+only for the rooms around the player no matter how big it is. Opening one
+doesn't read any rooms at all.
+
+The file is HEADER, then the marshalled list of tile colors the kinds were
+numbered by, then (starting on a page boundary) one chunk per room, row by
+row. A chunk is the room's kinds as bytes, indexed [x, y], so every chunk
+is room_size * room_size bytes and room (x, y) is easy to find.
+
+Usage: python world.py map.png out.world   (converts a map image, with one
+                                           pixel per tile, to a world)"""
+
+import marshal
+import mmap
+import os
+import struct
+
+import numpy as N
+
+EXTENSION = ".world"
+
+MAGIC = "FATHOMW1"
+HEADER = struct.Struct("<8sHHHII")      # magic, room size, rooms across, rooms
+                                        # down, kinds length, chunks offset
+
+class World(object):
+  """A world file, mapped into memory."""
+
+  def __init__(self, path):
+    self.file = open(path, "rb")
+    self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if len(self.data) < HEADER.size or self.data[:len(MAGIC)] != MAGIC:
+      self.close()
+      raise ValueError("%s isn't a world" % path)
+
+    magic, self.room_size, self.rooms_across, self.rooms_down, kinds_length, self.offset = \
+      HEADER.unpack_from(self.data, 0)
+
+    self.kinds = marshal.loads(self.data[HEADER.size:HEADER.size + kinds_length])
+    self.chunk_size = self.room_size * self.room_size
+
+    if len(self.data) < self.offset + self.rooms_across * self.rooms_down * self.chunk_size:
+      self.close()
+      raise ValueError("%s is cut short" % path)
+
+  def close(self):
+    self.data.close()
+    self.file.close()
+
+  def rooms(self):
+    """How many rooms across and down the world is."""
+    return self.rooms_across, self.rooms_down
+
+  def room_kinds(self, mapx, mapy):
+    """The tile kinds of room (MAPX, MAPY), indexed [x, y]. Only reads that
+    room's chunk."""
+    if not (0 <= mapx < self.rooms_across and 0 <= mapy < self.rooms_down):
+      raise IndexError("no room (%d, %d) in a %dx%d world" % (mapx, mapy, self.rooms_across, self.rooms_down))
+
+    start = self.offset + (mapy * self.rooms_across + mapx) * self.chunk_size
+    chunk = N.frombuffer(self.data[start:start + self.chunk_size], dtype=N.uint8)
+    return chunk.reshape(self.room_size, self.room_size).copy()
+
+def write(path, room_size, rooms_across, rooms_down, kinds, room_kinds):
+  """Writes a world to PATH. KINDS are the tile colors the kinds are numbers
+  of; ROOM_KINDS(mapx, mapy) gives a room's kinds, indexed [x, y]. Rooms are
+  asked for one at a time and written straight out, so the world never has
+  to fit in memory."""
+  kinds_data = marshal.dumps([tuple(kind) for kind in kinds])
+
+  # Start the chunks on a page, so that a room never shares a page with the
+  # header.
+  offset = HEADER.size + len(kinds_data)
+  offset += -offset % mmap.ALLOCATIONGRANULARITY
+
+  # Write next to it and move it into place, so a half-written world never
+  # gets loaded.
+  temp = path + ".tmp"
+  with open(temp, "wb") as f:
+    f.write(HEADER.pack(MAGIC, room_size, rooms_across, rooms_down, len(kinds_data), offset))
+    f.write(kinds_data)
+    f.write("\0" * (offset - f.tell()))
+
+    for mapy in range(rooms_down):
+      for mapx in range(rooms_across):
+        chunk = N.asarray(room_kinds(mapx, mapy), dtype=N.uint8)
+        assert chunk.shape == (room_size, room_size)
+        f.write(chunk.tostring())
+  os.rename(temp, path)
+
+def convert(image_path, path, room_size, tile_kinds, kinds):
+  """Converts the map image at IMAGE_PATH (one pixel per tile) to a world at
+  PATH. TILE_KINDS is Tile.kinds_of."""
+  import pygame
+
+  image = pygame.image.load(image_path)
+  width, height = image.get_size()
+  rooms_across, rooms_down = width // room_size, height // room_size
+
+  def room_kinds(mapx, mapy):
+    room = image.subsurface((mapx * room_size, mapy * room_size, room_size, room_size))
+    return tile_kinds(pygame.surfarray.array3d(room))
+
+  write(path, room_size, rooms_across, rooms_down, kinds, room_kinds)
+  return rooms_across, rooms_down
+
+if __name__ == "__main__":
+  import sys
+  import time
+
+  if len(sys.argv) != 3:
+    print __doc__.split("Usage: ")[1]
+    sys.exit(1)
+
+  os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+  import main
+
+  start = time.time()
+  rooms_across, rooms_down = convert(sys.argv[1], sys.argv[2], main.MAP_SIZE, main.Tile.kinds_of, main.Tile.KINDS)
+  print "%s: %dx%d rooms, %d bytes, %.2fs" % (sys.argv[2], rooms_across, rooms_down,
+                                             os.path.getsize(sys.argv[2]), time.time() - start)